@@ -0,0 +1,93 @@
+"""
+Disk space checks used by the run combiner scheduler, so that a merge is only
+started when its output fits on the disk it is written to. This script is not
+meant to be called as a standalone script, rather it is called from the run
+combiner script.
+
+The size of a merged file is estimated from the sizes of the lane files that
+still have to be appended to it: a concat merge writes exactly as many bytes
+as it reads, a recompress merge about as many (times recompress_ratio), as the
+data is never written to disk uncompressed. A merge is admitted when its
+estimate fits in the free space of the filesystem, less a safety margin and
+less the space reserved by the merges that are already running.
+"""
+
+import os
+import threading
+
+def estimate_output(sizes, merge_mode="concat", recompress_ratio=1.1):
+    """
+    Return the estimated number of bytes a merge of lane files with the given
+    sizes adds to its output.
+    """
+    total = sum(sizes)
+    if merge_mode == "recompress":
+        return int(total * recompress_ratio)
+    return total
+
+def disk_space(path):
+    """
+    Return (free bytes, total bytes) of the filesystem path is on, counting
+    only the space that is available to unprivileged users.
+    """
+    stat = os.statvfs(path)
+    return (stat.f_bavail * stat.f_frsize, stat.f_blocks * stat.f_frsize)
+
+class DiskBudget(object):
+    """
+    Space reserved on every filesystem, by device number, for the merges
+    that this process is running. margin_percent of every filesystem is
+    always kept free. Safe to use from several threads; wait lets a thread
+    sleep until a reservation is given back or more space is freed.
+    """
+
+    def __init__(self, margin_percent=5):
+        self.margin_percent = margin_percent
+        self.reserved = {}
+        self.changed = threading.Condition()
+
+    def admit(self, path, estimate):
+        """
+        Reserve estimate bytes on the filesystem of path and return the
+        reservation, a (device, bytes) pair to give to release, if they fit.
+        Otherwise return None.
+        """
+        device = os.stat(path).st_dev
+        free, total = disk_space(path)
+        with self.changed:
+            available = (free - self.reserved.get(device, 0) -
+                         total * self.margin_percent / 100.0)
+            if estimate > available:
+                return None
+            self.reserved[device] = self.reserved.get(device, 0) + estimate
+        return (device, estimate)
+
+    def release(self, reservation):
+        with self.changed:
+            device, estimate = reservation
+            self.reserved[device] -= estimate
+            if not self.reserved[device]:
+                del self.reserved[device]
+            self.changed.notify_all()
+
+    def busy(self):
+        """
+        Return True if any space is reserved by running merges.
+        """
+        with self.changed:
+            return bool(self.reserved)
+
+    def wait(self, timeout):
+        with self.changed:
+            self.changed.wait(timeout)
+
+    def available(self, path):
+        """
+        Return the bytes that a new merge on the filesystem of path could
+        use now.
+        """
+        device = os.stat(path).st_dev
+        free, total = disk_space(path)
+        with self.changed:
+            return max(0, int(free - self.reserved.get(device, 0) -
+                              total * self.margin_percent / 100.0))
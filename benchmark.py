@@ -0,0 +1,279 @@
+"""
+Benchmark for the run combiner. It generates synthetic sequencing runs, with
+gzipped fastq files for every sample, lane and read, an md5sums.txt and a
+SampleSheet.csv, and then times the stages the run combiner goes through for
+every run: checking the md5 sums, indexing and grouping the lane files, and
+merging them. The merge jobs are queued in a run database in the benchmark
+folder and worked on by work_queue, as the run combiner does.
+
+For every stage it reports the wall time, the CPU time of the process and
+of the programs it ran (pigz or gzip) that have finished, the peak
+resident memory, the bytes read and written (from /proc/self/io where
+available) and the throughput in GB/s of input data. The peak resident
+memory is the highest the process has reached so far, not that of the
+stage: the stages run one after the other in the same process, so a stage
+only shows up in it if it went higher than all the stages before it. The
+results are printed, and written as JSON with --json.
+
+Example:
+
+python benchmark.py --runs 2 --samples 4 --lanes 4 --lane_mb 64 \\
+    --merge_mode concat --json results.json
+"""
+
+import os
+import sys
+import gzip
+import json
+import shutil
+import hashlib
+import argparse
+import resource
+import tempfile
+from time import time
+
+import run_combiner
+from compression import compression_settings
+from run_index import index_run
+
+BASES = b"ACGT" * 64
+QUALITIES = b"FFFFF:::,," * 25 + b"FFFFFF"
+
+def proc_io():
+    """
+    Return the rchar, wchar, read_bytes and write_bytes counters of this
+    process from /proc/self/io, or an empty dictionary where that is not
+    available.
+    """
+    counters = {}
+    try:
+        with open("/proc/self/io", "r") as io_file:
+            for line in io_file:
+                key, _, value = line.partition(":")
+                counters[key] = int(value)
+    except (IOError, OSError, ValueError):
+        return {}
+    return counters
+
+class Stage(object):
+    """
+    Measure one stage of the benchmark. Used as a context manager; the
+    measurements are in result afterwards. input_bytes is the amount of data
+    the stage works through, used for the throughput.
+    """
+
+    def __init__(self, name, input_bytes=0):
+        self.name = name
+        self.input_bytes = input_bytes
+        self.result = None
+
+    def __enter__(self):
+        self.start_io = proc_io()
+        self.start_usage = resource.getrusage(resource.RUSAGE_SELF)
+        self.start_children = resource.getrusage(resource.RUSAGE_CHILDREN)
+        self.start = time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        wall = time() - self.start
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        children = resource.getrusage(resource.RUSAGE_CHILDREN)
+        end_io = proc_io()
+        self.result = {
+            "stage": self.name,
+            "wall_seconds": wall,
+            "cpu_seconds": (usage.ru_utime - self.start_usage.ru_utime +
+                            usage.ru_stime - self.start_usage.ru_stime),
+            "child_cpu_seconds": (children.ru_utime - 
+                                  self.start_children.ru_utime +
+                                  children.ru_stime - 
+                                  self.start_children.ru_stime),
+            "peak_rss_so_far_mb": usage.ru_maxrss / 1024.0,
+            "input_bytes": self.input_bytes,
+            "gb_per_second": (self.input_bytes / wall / 1e9 if wall > 0
+                              else None)}
+        for key in ("rchar", "wchar", "read_bytes", "write_bytes"):
+            if key in end_io and key in self.start_io:
+                self.result[key] = end_io[key] - self.start_io[key]
+        return False
+
+def fastq_records(read_length, size):
+    """
+    Return roughly size bytes of uncompressed fastq records with random
+    bases, so that the data compresses about as well as real reads.
+    """
+    records = []
+    total = 0
+    number = 0
+    quality = (QUALITIES * (read_length // len(QUALITIES) + 1))[:read_length]
+    while total < size:
+        sequence = bytearray(os.urandom(read_length)).translate(
+            bytearray(BASES))
+        record = (b"@SYNTHETIC:1:FC:1:1:" + str(number).encode("ascii") +
+                  b" 1:N:0:1\n" + bytes(sequence) + b"\n+\n" + quality + b"\n")
+        records.append(record)
+        total += len(record)
+        number += 1
+    return b"".join(records)
+
+def make_run(folder, name, samples, lanes, read_length, lane_bytes,
+             in_folder):
+    """
+    Write a synthetic run called name in folder, with samples samples of
+    lanes lanes and two reads each, every lane file holding about lane_bytes
+    of uncompressed fastq data. Returns the size of the gzipped lane files.
+    """
+    run = os.path.join(folder, name)
+    in_dir = os.path.join(run, in_folder)
+    os.makedirs(in_dir)
+    with open(os.path.join(run, "SampleSheet.csv"), "w") as sheet:
+        sheet.write("[Header]\nInvestigator Name,benchmark@localhost\n"
+                    "[Data]\nLane,Sample_ID,Sample_Name\n")
+        for lane in range(1, lanes + 1):
+            for sample in range(1, samples + 1):
+                sheet.write("{},ID{},Sample{}\n".format(lane, sample, sample))
+    data = fastq_records(read_length, lane_bytes)
+    total = 0
+    with open(os.path.join(in_dir, "md5sums.txt"), "w") as md5sums:
+        for sample in range(1, samples + 1):
+            for lane in range(1, lanes + 1):
+                for read in ("R1", "R2"):
+                    file_name = ("{}_Sample{}_S{}_L{:03d}_{}_001.fastq.gz"
+                                 .format(name, sample, sample, lane, read))
+                    path = os.path.join(in_dir, file_name)
+                    with gzip.open(path, "wb", 1) as fastq:
+                        fastq.write(data)
+                    md5 = hashlib.md5()
+                    with open(path, "rb") as fastq:
+                        for block in iter(lambda: fastq.read(1 << 20), b""):
+                            md5.update(block)
+                    md5sums.write("{}  {}\n".format(md5.hexdigest(),
+                                                    file_name))
+                    total += os.path.getsize(path)
+    return total
+
+def benchmark(args):
+    folder = args.workdir or tempfile.mkdtemp(prefix="run_combiner_bench_")
+    in_folder = "Demultiplexing"
+    config_ = {"runs": {"runs_folder": folder, "in_folder": in_folder,
+                        "out_folder": "merged", "keep_original_files": True,
+                        "merge_mode": args.merge_mode},
+               "email": {"admin": "benchmark@localhost",
+                         "use_ss_email": False},
+               "scheduler": {"max_workers": args.workers,
+                             "max_io_jobs": args.workers, "max_attempts": 1},
+               "verify_transfer": {"use_md5": False},
+               "database": {"table_name": "benchmark"},
+               "compression": {"backend": args.backend, "level": args.level,
+                               "threads": args.threads}}
+    config_["compression_settings"] = compression_settings(config_)
+    runs = ["BENCH{}".format(number) for number in range(1, args.runs + 1)]
+    results = {"parameters": vars(args), "stages": []}
+    try:
+        with Stage("generate") as stage:
+            input_bytes = sum(make_run(folder, run, args.samples, args.lanes,
+                                       args.read_length,
+                                       args.lane_mb * 1024 * 1024, in_folder)
+                              for run in runs)
+            stage.input_bytes = input_bytes
+        results["stages"].append(stage.result)
+
+        with Stage("check_md5", input_bytes) as stage:
+            for run in runs:
+                statuses = run_combiner.check_md5(os.path.join(folder, run,
+                                                               in_folder),
+                                                  args.md5_workers)
+                if any(status != "OK" for status in statuses.values()):
+                    raise ValueError("md5 check failed for {}".format(run))
+        results["stages"].append(stage.result)
+
+        with Stage("group") as stage:
+            jobs = []
+            for run in runs:
+                path = os.path.join(folder, run)
+                index = index_run(path, in_folder)
+                ss_info = run_combiner.parse_sample_sheet(
+                    path, "benchmark@localhost", False)
+                jobs.extend(run_combiner.build_merge_jobs(
+                    path, index.samples, ss_info[0]))
+        results["stages"].append(stage.result)
+
+        conn = run_combiner.connect_to_db(folder, "benchmark.sqlite")
+        run_combiner.check_db_table(conn, "benchmark")
+        post = run_combiner.PostMerge(conn, "benchmark",
+                                      config_["email"]["admin"])
+        post.start()
+        try:
+            with Stage("merge", input_bytes) as stage:
+                run_combiner.queue_jobs(conn, "benchmark", jobs)
+                for run in runs:
+                    run_combiner.set_run_status(conn, "benchmark",
+                                                os.path.join(folder, run),
+                                                "Merging")
+                merged = run_combiner.work_queue(config_, conn, post)
+        finally:
+            post.stop()
+            conn.close()
+        failed = [result for result in merged if not result["ok"]]
+        if failed:
+            raise ValueError("{} merges failed: {}".format(
+                len(failed), failed[0]["error"]))
+        stage.result["output_bytes"] = sum(os.path.getsize(result["output"])
+                                           for result in merged)
+        results["stages"].append(stage.result)
+    finally:
+        if not args.keep and not args.workdir:
+            shutil.rmtree(folder, ignore_errors=True)
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=1,
+                        help="Number of runs to generate (default 1)")
+    parser.add_argument("--samples", type=int, default=4,
+                        help="Samples per run (default 4)")
+    parser.add_argument("--lanes", type=int, default=4,
+                        help="Lanes per sample (default 4)")
+    parser.add_argument("--read_length", type=int, default=150,
+                        help="Read length in bases (default 150)")
+    parser.add_argument("--lane_mb", type=int, default=16,
+                        help=("Uncompressed fastq data per lane file in MiB "
+                              "(default 16)"))
+    parser.add_argument("--merge_mode", choices=("concat", "recompress"),
+                        default="concat", help="Merge mode (default concat)")
+    parser.add_argument("--backend", default="auto",
+                        help="Compression backend for recompress (default auto)")
+    parser.add_argument("--level", type=int, default=6,
+                        help="Compression level for recompress (default 6)")
+    parser.add_argument("--threads", type=int, default=4,
+                        help="Compression threads for recompress (default 4)")
+    parser.add_argument("--workers", type=int, default=4,
+                        help="Merges run at the same time (default 4)")
+    parser.add_argument("--md5_workers", type=int, default=4,
+                        help="Threads used for the md5 check (default 4)")
+    parser.add_argument("--workdir", help=("Folder to generate the runs in. "
+                                           "It is kept afterwards (default: a "
+                                           "temporary folder)"))
+    parser.add_argument("--keep", action="store_true",
+                        help="Keep the temporary folder afterwards")
+    parser.add_argument("--json", help="Write the results to this file")
+    args = parser.parse_args()
+
+    results = benchmark(args)
+    for stage in results["stages"]:
+        print("{stage:>10}: {wall_seconds:8.2f} s wall, {cpu_seconds:8.2f} s "
+              "CPU, {child_cpu_seconds:8.2f} s child CPU, "
+              "{peak_rss_so_far_mb:8.1f} MiB peak RSS so far".format(**stage) +
+              (", {:.3f} GB/s".format(stage["gb_per_second"])
+               if stage["input_bytes"] and stage["gb_per_second"] else "") +
+              (", {} bytes read, {} bytes written".format(stage["rchar"],
+                                                          stage["wchar"])
+               if "rchar" in stage else ""))
+    if args.json:
+        with open(args.json, "w") as json_file:
+            json.dump(results, json_file, indent=2, sort_keys=True)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
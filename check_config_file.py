@@ -4,6 +4,7 @@ Script to parse config files used in the run combiner. This script is not meant
   script.
 """
 
+import os
 import argparse
 
 def check_config(config_):
@@ -25,6 +26,28 @@ def check_config(config_):
                 raise KeyError("Please indicate if you want to parse the "
                                "sample sheet for the investigator email. "
                                "Valid entries are yes|no, True|False.")
+            transport = config_["email"].get("transport", "sendmail")
+            if transport not in ("sendmail", "smtp", "file"):
+                raise KeyError("Invalid transport in the email section of the "
+                               "config file. Valid entries are sendmail|smtp|"
+                               "file.")
+            if transport == "file" and not config_["email"].get("sink_folder"):
+                raise KeyError("The file transport in the email section of "
+                               "the config file needs a sink_folder to write "
+                               "the emails to.")
+            for key in ("smtp_port", "max_attempts"):
+                if key in config_["email"]:
+                    value = config_["email"][key]
+                    if not isinstance(value, int) or value < 1:
+                        raise KeyError("{} in the email section of the config "
+                                       "file must be a whole number of at "
+                                       "least 1.".format(key))
+            if "retry_seconds" in config_["email"]:
+                value = config_["email"]["retry_seconds"]
+                if not isinstance(value, (int, float)) or value <= 0:
+                    raise KeyError("retry_seconds in the email section of the "
+                                   "config file must be a number of seconds "
+                                   "greater than 0.")
         
     if "runs" not in config_:
         raise KeyError("Runs field missing from config file. Please add a "
@@ -50,6 +73,21 @@ def check_config(config_):
                 raise KeyError("The runs folder is missing from the config file. "
                                "Please enter the runs folder in the following "
                                "format: runs_folder: /path/to/runs_folder")
+            if config_["runs"].get("merge_mode", "concat") not in ("concat",
+                                                                  "recompress"):
+                raise KeyError("Invalid merge_mode in the runs section of the "
+                               "config file. Valid entries are concat|"
+                               "recompress.")
+            if not isinstance(config_["runs"].get("link_single_lane", True),
+                              bool):
+                raise KeyError("link_single_lane in the runs section of the "
+                               "config file must be yes|no.")
+            if "expected_lanes" in config_["runs"]:
+                value = config_["runs"]["expected_lanes"]
+                if not isinstance(value, int) or value < 1:
+                    raise KeyError("expected_lanes in the runs section of the "
+                                   "config file must be a whole number of at "
+                                   "least 1.")
         
     if "logging" not in config_:
         raise KeyError("Logging field missing from config file. Please add a "
@@ -77,9 +115,80 @@ def check_config(config_):
                                "verify file transfer. Valid entries are yes|no "
                                "True|False. Will use file modification time if "
                                "no")
-            if "md5_path" not in config_["verify_transfer"]:
-                raise KeyError("Please enter the path to the md5sum program. "
-                               "On Linux this is usually /usr/bin/md5sum")
+            if "md5_workers" in config_["verify_transfer"]:
+                value = config_["verify_transfer"]["md5_workers"]
+                if not isinstance(value, int) or value < 1:
+                    raise KeyError("md5_workers in the verify_transfer "
+                                   "section of the config file must be a "
+                                   "whole number of at least 1.")
+        
+    if config_.get("database") is not None:
+        if not isinstance(config_["database"].get("shared", False), bool):
+            raise KeyError("shared in the database section of the config file "
+                           "must be yes|no.")
+    if config_.get("scheduler") is not None:
+        for key in ("max_workers", "max_io_jobs", "max_attempts"):
+            if key in config_["scheduler"]:
+                value = config_["scheduler"][key]
+                if not isinstance(value, int) or value < 1:
+                    raise KeyError("{} in the scheduler section of the config "
+                                   "file must be a whole number of at least "
+                                   "1.".format(key))
+        for key in ("heartbeat_seconds", "stale_seconds"):
+            if key in config_["scheduler"]:
+                value = config_["scheduler"][key]
+                if not isinstance(value, (int, float)) or value <= 0:
+                    raise KeyError("{} in the scheduler section of the config "
+                                   "file must be a number of seconds greater "
+                                   "than 0.".format(key))
+        margin = config_["scheduler"].get("space_margin_percent", 5)
+        if not isinstance(margin, (int, float)) or not 0 <= margin < 100:
+            raise KeyError("space_margin_percent in the scheduler section of "
+                           "the config file must be a number from 0 to 100.")
+        ratio = config_["scheduler"].get("recompress_ratio", 1.1)
+        if not isinstance(ratio, (int, float)) or ratio <= 0:
+            raise KeyError("recompress_ratio in the scheduler section of the "
+                           "config file must be a number greater than 0.")
+    if config_.get("daemon") is not None:
+        for key in ("settle_seconds", "retry_seconds", "poll_seconds"):
+            if key in config_["daemon"]:
+                value = config_["daemon"][key]
+                if (not isinstance(value, (int, float)) or value < 0 or
+                        key == "poll_seconds" and value <= 0):
+                    raise KeyError("{} in the daemon section of the config "
+                                   "file must be a number of seconds{}."
+                                   .format(key, " greater than 0" if key == 
+                                           "poll_seconds" else ""))
+    if config_.get("compression") is not None:
+        if config_["compression"].get("backend", "auto") not in ("auto",
+                                                                 "builtin",
+                                                                 "pigz",
+                                                                 "gzip"):
+            raise KeyError("Invalid backend in the compression section of the "
+                           "config file. Valid entries are auto|builtin|pigz|"
+                           "gzip.")
+        if config_["compression"].get("level", 6) not in range(1, 10):
+            raise KeyError("The compression level in the config file must be "
+                           "a whole number from 1 to 9.")
+        threads = config_["compression"].get("threads", 4)
+        if not isinstance(threads, int) or threads < 1:
+            raise KeyError("threads in the compression section of the config "
+                           "file must be a whole number of at least 1.")
+        buffer_mb = config_["compression"].get("buffer_mb", 16)
+        if not isinstance(buffer_mb, int) or buffer_mb < 1:
+            raise KeyError("buffer_mb in the compression section of the "
+                           "config file must be a whole number of at least 1.")
+    if config_.get("metrics") is not None:
+        if "textfile" in config_["metrics"]:
+            textfile = config_["metrics"]["textfile"]
+            if not textfile or not os.path.isdir(os.path.dirname(
+                    os.path.abspath(textfile))):
+                raise KeyError("The folder of textfile in the metrics section "
+                               "of the config file does not exist.")
+        window = config_["metrics"].get("window_hours", 24)
+        if not isinstance(window, (int, float)) or window <= 0:
+            raise KeyError("window_hours in the metrics section of the config "
+                           "file must be a number of hours greater than 0.")
         
 def main(config_file):
     
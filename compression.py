@@ -0,0 +1,253 @@
+"""
+Compression backends used by the run combiner when merged files are
+recompressed. This script is not meant to be called as a standalone script,
+rather it is called from the run combiner script.
+
+The backends are:
+
+builtin: compresses independent blocks of the input on a pool of threads and
+         writes them out in order as one deflate stream, so that the output
+         is a single gzip member however many compressors wrote to it. With
+         bgzf it writes a BGZF file instead, which is made of many small
+         gzip members by design.
+pigz:    pipes the data through an external pigz process.
+gzip:    pipes the data through an external, single-threaded gzip process.
+auto:    builtin.
+
+Every compressor from open_compressor that pigz or gzip writes through adds
+a gzip member of its own, so the run combiner keeps one of them open for a
+whole merged file. Only the builtin backend can carry a single member on
+from one compressor to the next, so that the merged file can be checkpointed
+after every lane file, which is why auto picks it even where pigz is
+installed.
+"""
+
+import os
+import struct
+import subprocess
+import zlib
+
+BLOCK_SIZE = 4 * 1024 * 1024
+BGZF_BLOCK_SIZE = 0xff00
+BGZF_EOF = (b"\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff\x06\x00\x42\x43\x02\x00"
+            b"\x1b\x00\x03\x00\x00\x00\x00\x00\x00\x00\x00\x00")
+GZIP_HEADER = b"\x1f\x8b\x08\x00\x00\x00\x00\x00\x00\xff"
+# An empty deflate block with the last block bit set, which ends a deflate
+# stream made of blocks that each end with a sync flush.
+LAST_BLOCK = b"\x03\x00"
+
+def find_program(name):
+    """
+    Return the full path to the program name if it is on the PATH, otherwise
+    None.
+    """
+    for folder in os.environ.get("PATH", "").split(os.pathsep):
+        path = os.path.join(folder, name)
+        if os.path.isfile(path) and os.access(path, os.X_OK):
+            return path
+    return None
+
+def thread_pool(threads):
+    """
+    Return a multiprocessing ThreadPool of threads threads. multiprocessing
+    is only imported here, the first time a pool is needed, as it is slow to
+    import and commands that only report never need one.
+    """
+    from multiprocessing.pool import ThreadPool
+    return ThreadPool(threads)
+
+def compression_settings(config_):
+    """
+    Return the compression settings from the compression section of the
+    config file with the defaults filled in, and backend auto resolved to the
+    backend that will actually be used.
+    """
+    section = config_.get("compression") or {}
+    settings = {"backend": section.get("backend", "auto"),
+                "level": section.get("level", 6),
+                "threads": section.get("threads", 4),
+                "bgzf": bool(section.get("bgzf", False)),
+                "buffer_size": section.get("buffer_mb", 16) * 1024 * 1024,
+                "pigz_path": find_program("pigz")}
+    if settings["backend"] == "auto":
+        settings["backend"] = "builtin"
+    if settings["backend"] == "pigz" and settings["pigz_path"] is None:
+        raise KeyError("The pigz compression backend was requested, but pigz "
+                       "could not be found on the PATH.")
+    if settings["bgzf"] and settings["backend"] != "builtin":
+        raise KeyError("BGZF output is only supported by the builtin "
+                       "compression backend.")
+    return settings
+
+def gzip_member(data, level, bgzf=False):
+    """
+    Compress data into one complete gzip member. With bgzf the member gets
+    the BC extra field that BGZF readers use to find the block boundaries.
+    """
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    deflated = compressor.compress(data) + compressor.flush()
+    trailer = struct.pack("<II", zlib.crc32(data) & 0xffffffff,
+                          len(data) & 0xffffffff)
+    if bgzf:
+        block_size = 12 + 6 + len(deflated) + 8
+        header = struct.pack("<BBBBIBBHBBHH", 0x1f, 0x8b, 8, 4, 0, 0, 0xff, 6,
+                             ord("B"), ord("C"), 2, block_size - 1)
+    else:
+        header = struct.pack("<BBBBIBB", 0x1f, 0x8b, 8, 0, 0, 0, 0xff)
+    return header + deflated + trailer
+
+def deflate_block(data, level):
+    """
+    Compress data into raw deflate blocks that end with a sync flush, on a
+    byte boundary and without the last block bit, so that the output of
+    several calls joined together is one deflate stream (see LAST_BLOCK).
+    """
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush(zlib.Z_SYNC_FLUSH)
+
+class BlockCompressor(object):
+    """
+    File-like writer that compresses blocks of the data written to it in
+    parallel on threads threads, and writes them to out_file in the order
+    the data came in. At most 2 * threads blocks are held in memory at any
+    time.
+    
+    With bgzf every block is a gzip member of its own. Otherwise the blocks
+    continue the single gzip member whose state, the (crc32, size) of the
+    data in it so far, is given; with no state the member is started. state
+    holds the state of the member once the compressor is closed, to be given
+    to the next compressor or to finish_output.
+    """
+
+    def __init__(self, out_file, level=6, threads=4, bgzf=False,
+                 block_size=None, state=None):
+        self.out_file = out_file
+        self.level = level
+        self.bgzf = bgzf
+        self.state = None
+        if not bgzf:
+            if state is None:
+                out_file.write(GZIP_HEADER)
+                state = (0, 0)
+            self.state = tuple(state)
+        self.block_size = block_size or (BGZF_BLOCK_SIZE if bgzf
+                                         else BLOCK_SIZE)
+        self.max_pending = 2 * threads
+        # Imported here, as it is slow to import and only needed when
+        # recompressing.
+        self.pool = thread_pool(threads)
+        self.pending = []
+        self.buffer = bytearray()
+
+    def write(self, data):
+        self.buffer.extend(data)
+        while len(self.buffer) >= self.block_size:
+            self._submit(bytes(self.buffer[:self.block_size]))
+            del self.buffer[:self.block_size]
+
+    def _submit(self, block):
+        if self.bgzf:
+            self.pending.append(self.pool.apply_async(gzip_member,
+                                                      (block, self.level,
+                                                       True)))
+        else:
+            self.state = (zlib.crc32(block, self.state[0]) & 0xffffffff,
+                          self.state[1] + len(block))
+            self.pending.append(self.pool.apply_async(deflate_block,
+                                                      (block, self.level)))
+        while len(self.pending) >= self.max_pending:
+            self.out_file.write(self.pending.pop(0).get())
+
+    def flush(self):
+        """
+        Compress and write out everything written so far. With bgzf the
+        output up to this point is a complete BGZF file, otherwise it needs
+        finish_output to become a complete gzip file.
+        """
+        if self.buffer:
+            self._submit(bytes(self.buffer))
+            self.buffer = bytearray()
+        while self.pending:
+            self.out_file.write(self.pending.pop(0).get())
+        self.out_file.flush()
+
+    def close(self):
+        try:
+            self.flush()
+        finally:
+            self.pool.close()
+            self.pool.join()
+
+    def abort(self):
+        """
+        Stop compressing and drop everything that has not been written yet.
+        """
+        self.pool.terminate()
+        self.pool.join()
+        self.pending = []
+        self.buffer = bytearray()
+
+class ProcessCompressor(object):
+    """
+    File-like writer that pipes the data written to it through an external
+    compression program, which writes a gzip member of its own to out_file.
+    """
+    
+    state = None
+
+    def __init__(self, out_file, command):
+        self.process = subprocess.Popen(command, stdin=subprocess.PIPE,
+                                        stdout=out_file)
+        self.command = command
+
+    def write(self, data):
+        self.process.stdin.write(data)
+
+    def close(self):
+        self.process.stdin.close()
+        if self.process.wait() != 0:
+            raise subprocess.CalledProcessError(self.process.returncode,
+                                                self.command)
+
+    def abort(self):
+        """
+        Stop the compression program without waiting for it to finish.
+        """
+        self.process.kill()
+        self.process.wait()
+
+def open_compressor(out_file, settings, state=None):
+    """
+    Return a writer that compresses the data written to it into the open
+    binary file out_file, using the backend in settings (see
+    compression_settings). The writer must be closed when all the data has
+    been written. Several writers can be used one after the other on the
+    same out_file, each given the state of the one before it (None for the
+    first), and finish_output must be called once at the end with the state
+    of the last. state is None for backends that write whole gzip members.
+    """
+    if settings["backend"] == "builtin":
+        return BlockCompressor(out_file, settings["level"], settings["threads"],
+                               settings["bgzf"], state=state)
+    if settings["backend"] == "pigz":
+        return ProcessCompressor(out_file, [settings["pigz_path"], "-c",
+                                            "-{}".format(settings["level"]),
+                                            "-p", str(settings["threads"])])
+    return ProcessCompressor(out_file, ["gzip", "-c",
+                                        "-{}".format(settings["level"])])
+
+def finish_output(out_file, settings, state=None):
+    """
+    Finish a compressed file written by one or more compressors from
+    open_compressor, the last of which left state. BGZF files end with an
+    empty block that marks the end of the file; the single gzip member of
+    the builtin backend is ended with the last deflate block and its trailer.
+    """
+    if settings["bgzf"]:
+        out_file.write(BGZF_EOF)
+    elif settings["backend"] == "builtin":
+        if state is None:
+            out_file.write(GZIP_HEADER)
+            state = (0, 0)
+        out_file.write(LAST_BLOCK + struct.pack("<II", state[0],
+                                                state[1] & 0xffffffff))
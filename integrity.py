@@ -0,0 +1,168 @@
+"""
+Checks on the merged files that are made while the data streams through the
+run combiner, so that a merged file never has to be read again to be
+validated. This script is not meant to be called as a standalone script,
+rather it is called from the run combiner script.
+
+FastqCounter counts the records and bases of the uncompressed fastq data of
+each lane file, and notices a lane file that does not end with a whole
+record. GzipStream decompresses gzip data that is fed to it in pieces, which
+lets the gzipped data copied by a concat merge be counted on the way.
+OutputDigest computes the md5 sum of a merged file from the data written to
+it.
+"""
+
+import os
+import zlib
+import hashlib
+
+READ_BUFFER_SIZE = 8 * 1024 * 1024
+
+class FastqCounter(object):
+    """
+    Count the records and bases of fastq data passed to count in pieces of
+    any size. Every record is four lines, the second of which is the
+    sequence.
+    """
+
+    def __init__(self):
+        self.lines = 0
+        self.bases = 0
+        self.tail = 0
+
+    def count(self, data):
+        parts = data.split(b"\n")
+        if len(parts) == 1:
+            self.tail += len(data)
+            return
+        if self.lines % 4 == 1:
+            self.bases += self.tail + len(parts[0])
+        # parts[1:-1] are whole lines, the first of which is line
+        # self.lines + 1 of the file.
+        first = (1 - (self.lines + 1)) % 4
+        self.bases += sum(map(len, parts[1 + first:-1:4]))
+        self.lines += len(parts) - 1
+        self.tail = len(parts[-1])
+
+    @property
+    def records(self):
+        return self.lines // 4
+
+    def complete(self):
+        """
+        Return True if the data counted so far ends with a whole record.
+        """
+        return self.tail == 0 and self.lines % 4 == 0
+
+class GzipStream(object):
+    """
+    Decompress gzip data, which may have several members, passed to update
+    in pieces, and pass the decompressed data to write, at most buffer_size
+    bytes at a time. finish must be called at the end. Corrupt data raises
+    an IOError.
+    """
+
+    def __init__(self, write, buffer_size=READ_BUFFER_SIZE):
+        self.write = write
+        self.buffer_size = buffer_size
+        self.decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+    def update(self, chunk):
+        while chunk:
+            try:
+                data = self.decompressor.decompress(chunk, self.buffer_size)
+            except zlib.error as e:
+                raise IOError("Corrupt gzip data: {}".format(e))
+            self.write(data)
+            if self.decompressor.unused_data:
+                chunk = self.decompressor.unused_data
+                self.decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            else:
+                chunk = self.decompressor.unconsumed_tail
+
+    def finish(self, name):
+        """
+        Pass on the last of the data, and raise an IOError if the gzip data
+        of name stopped in the middle of a member.
+        """
+        try:
+            data = self.decompressor.flush()
+        except zlib.error as e:
+            raise IOError("{} is not a valid gzip file: {}".format(name, e))
+        self.write(data)
+        if not getattr(self.decompressor, "eof", True):
+            raise IOError("{} is truncated.".format(name))
+
+class Tee(object):
+    """
+    Pass the data given to update on to the update method of every object in
+    targets that is not None.
+    """
+
+    def __init__(self, *targets):
+        self.targets = [target for target in targets if target is not None]
+
+    def update(self, data):
+        for target in self.targets:
+            target.update(data)
+
+class OutputDigest(object):
+    """
+    md5 sum of the file at path, computed from the data that is written to
+    it. update takes the data as it is written; catch_up reads whatever part
+    of the file was written some other way (by a compression program, or
+    before a merge was resumed) back from the file.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.md5 = hashlib.md5()
+        self.offset = 0
+
+    def update(self, data):
+        self.md5.update(data)
+        self.offset += len(data)
+
+    def catch_up(self, out_file):
+        """
+        Hash the part of the open file out_file past the data hashed so far.
+        """
+        out_file.flush()
+        size = os.fstat(out_file.fileno()).st_size
+        if size < self.offset:
+            raise IOError("{} is shorter than the data written to it."
+                          .format(self.path))
+        if size == self.offset:
+            return
+        with open(self.path, "rb") as written:
+            written.seek(self.offset)
+            while self.offset < size:
+                chunk = written.read(min(READ_BUFFER_SIZE, size - self.offset))
+                if not chunk:
+                    raise IOError("{} changed while it was being hashed."
+                                  .format(self.path))
+                self.update(chunk)
+
+    def hexdigest(self):
+        return self.md5.hexdigest()
+
+class HashingWriter(object):
+    """
+    Writer that passes the data written to it on to out_file and to digest.
+    fileno is that of out_file, so data written to the file descriptor
+    directly is not hashed (see OutputDigest.catch_up).
+    """
+
+    def __init__(self, out_file, digest):
+        self.out_file = out_file
+        self.digest = digest
+
+    def write(self, data):
+        self.out_file.write(data)
+        self.digest.update(data)
+
+    def flush(self):
+        self.out_file.flush()
+
+    def fileno(self):
+        return self.out_file.fileno()
@@ -0,0 +1,134 @@
+"""
+Liveness tracking used by the run combiner, so that several copies of the
+script can work on the same runs folder without getting in each other's way.
+This script is not meant to be called as a standalone script, rather it is
+called from the run combiner script.
+
+Every process that works on a run holds an advisory lock on a lock file for
+that run, and keeps a heartbeat timestamp for the run, and for the merge jobs
+it is running, up to date in the run database. A run or job is abandoned when
+its heartbeat is older than the timeout, or when the process that worked on
+it no longer exists on this host. Nothing here starts a subprocess.
+"""
+
+import os
+import errno
+import fcntl
+import socket
+import threading
+import logging
+
+NODE_NAME = [socket.gethostname()]
+
+def node_name():
+    """
+    Return the name this process is known by in the run database, which is
+    the host name unless it was changed with set_node_name.
+    """
+    return NODE_NAME[0]
+
+def set_node_name(name):
+    """
+    Change the name this process is known by in the run database. This lets
+    several processes on one host stand in for separate nodes.
+    """
+    NODE_NAME[0] = name
+
+def process_alive(pid):
+    """
+    Return True if a process with the given pid exists on this host.
+    """
+    if not pid:
+        return False
+    if os.path.isdir("/proc"):
+        return os.path.exists("/proc/{}".format(pid))
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno == errno.EPERM
+    return True
+
+class RunLock(object):
+    """
+    Advisory lock on the lock file of a run in lock_dir. The lock is a POSIX
+    record lock (fcntl.lockf), which is also honoured over NFS, and is dropped
+    by the operating system if the process dies. The lock file holds the host
+    name and pid of the process holding the lock.
+    """
+
+    def __init__(self, lock_dir, run_id):
+        self.lock_dir = lock_dir
+        self.path = os.path.join(lock_dir, os.path.basename(run_id) + ".lock")
+        self.fd = None
+
+    def acquire(self):
+        """
+        Try to take the lock without waiting. Returns True if the lock was
+        taken, and False if another process holds it.
+        """
+        try:
+            os.mkdir(self.lock_dir)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.lockf(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except (IOError, OSError) as e:
+            os.close(fd)
+            if e.errno in (errno.EACCES, errno.EAGAIN):
+                return False
+            raise
+        os.ftruncate(fd, 0)
+        os.write(fd, "{} {}\n".format(node_name(), 
+                                      os.getpid()).encode("utf-8"))
+        self.fd = fd
+        return True
+
+    def release(self):
+        if self.fd is not None:
+            fcntl.lockf(self.fd, fcntl.LOCK_UN)
+            os.close(self.fd)
+            self.fd = None
+
+class Heartbeat(object):
+    """
+    Background thread that calls beat with the list of runs held by this
+    process every interval seconds, until it is stopped. beat is called even
+    when no runs are held, so that it can also keep the jobs this process is
+    running alive.
+    """
+
+    def __init__(self, beat, interval=30):
+        self.beat = beat
+        self.interval = interval
+        self.runs = set()
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+
+    def add(self, run_id):
+        with self.lock:
+            self.runs.add(run_id)
+
+    def remove(self, run_id):
+        with self.lock:
+            self.runs.discard(run_id)
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+
+    def _run(self):
+        while not self.stopped.wait(self.interval):
+            with self.lock:
+                runs = list(self.runs)
+            try:
+                self.beat(runs)
+            except Exception:
+                logging.error("Updating the heartbeat of {} failed."
+                              .format(runs), exc_info = True)
@@ -0,0 +1,200 @@
+"""
+Per-stage timing and I/O counters used by the run combiner. This script is not
+meant to be called as a standalone script, rather it is called from the run
+combiner script.
+
+Every stage of the work on a run (scan, verify, sample_sheet, concat, link,
+decompress, compress, delete and notify) is measured with measure, which
+records how often the stage ran, its wall time, the CPU time of the thread
+that ran it and the bytes it read and wrote, for every run and merged file.
+The measurements are collected in memory and taken out after every pass to be
+saved in the run database. write_textfile writes the totals per run and stage
+in the Prometheus text format, for the textfile collector of the node
+exporter.
+"""
+
+import os
+import threading
+from time import time
+
+try:
+    from time import thread_time
+except ImportError:
+    thread_time = None
+
+STAGES = ("scan", "verify", "sample_sheet", "concat", "link", "decompress",
+          "compress", "delete", "notify")
+# Name, type and help text of every exported metric, in the order of the
+# values in a row from Metrics.take.
+EXPORTED = (("run_combiner_stage_runs_total", "counter",
+             "Number of times the stage ran."),
+            ("run_combiner_stage_seconds_total", "counter",
+             "Wall time spent in the stage."),
+            ("run_combiner_stage_cpu_seconds_total", "counter",
+             "CPU time spent in the stage."),
+            ("run_combiner_stage_read_bytes_total", "counter",
+             "Bytes read by the stage."),
+            ("run_combiner_stage_written_bytes_total", "counter",
+             "Bytes written by the stage."))
+
+def cpu_time():
+    """
+    Return the CPU time used by the current thread, or by the whole process
+    where the thread's own CPU time can not be read.
+    """
+    if thread_time is not None:
+        return thread_time()
+    times = os.times()
+    return times[0] + times[1]
+
+class Timer(object):
+    """
+    Add up the wall and CPU time of several separate stretches of work. Used
+    as a context manager around each of them.
+    """
+
+    def __init__(self):
+        self.seconds = 0.0
+        self.cpu_seconds = 0.0
+
+    def __enter__(self):
+        self.start = time()
+        self.start_cpu = cpu_time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.seconds += time() - self.start
+        self.cpu_seconds += cpu_time() - self.start_cpu
+        return False
+
+class Stage(object):
+    """
+    One measurement of stage for the merged file name of run, made by
+    Metrics.measure. The code in the stage adds the bytes it reads and writes
+    to bytes_read and bytes_written. The measurement is recorded when the
+    stage ends, also when it fails.
+    """
+
+    def __init__(self, metrics, stage, run, name):
+        self.metrics = metrics
+        self.stage = stage
+        self.run = run
+        self.name = name
+        self.bytes_read = 0
+        self.bytes_written = 0
+        self.timer = Timer()
+
+    def __enter__(self):
+        self.timer.__enter__()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.timer.__exit__(exc_type, exc_value, traceback)
+        self.metrics.add(self.stage, self.run, self.name, self.timer.seconds,
+                         self.timer.cpu_seconds, self.bytes_read,
+                         self.bytes_written)
+        return False
+
+class Metrics(object):
+    """
+    Totals of every stage, in the form {(run, name, stage): [runs, seconds,
+    cpu seconds, bytes read, bytes written]}. name is the merged file the
+    stage worked on, or "" for stages that work on the whole run. Safe to use
+    from several threads.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.totals = {}
+
+    def measure(self, stage, run="", name=""):
+        """
+        Return a context manager that measures one run of stage (see Stage).
+        """
+        return Stage(self, stage, run, name)
+
+    def add(self, stage, run, name, seconds, cpu_seconds, bytes_read=0,
+            bytes_written=0):
+        """
+        Record one run of stage that was measured some other way.
+        """
+        with self.lock:
+            total = self.totals.setdefault((run, name, stage),
+                                           [0, 0.0, 0.0, 0, 0])
+            for index, value in enumerate((1, seconds, cpu_seconds,
+                                           bytes_read, bytes_written)):
+                total[index] += value
+
+    def take(self):
+        """
+        Return the totals recorded since the last call as a list of (run,
+        name, stage, runs, seconds, cpu seconds, bytes read, bytes written),
+        and start again from zero.
+        """
+        with self.lock:
+            totals, self.totals = self.totals, {}
+        return sorted(key + tuple(values) for key, values in totals.items())
+
+METRICS = Metrics()
+measure = METRICS.measure
+
+def label_value(value):
+    return (value.replace("\\", "\\\\").replace("\"", "\\\"")
+            .replace("\n", "\\n"))
+
+def run_device(run):
+    """
+    Return the device number of the filesystem run is on, as major:minor, or
+    "" if run no longer exists.
+    """
+    try:
+        device = os.stat(run).st_dev
+    except OSError:
+        return ""
+    return "{}:{}".format(os.major(device), os.minor(device))
+
+def prometheus_text(rows):
+    """
+    Return rows in the form (run, stage, runs, seconds, cpu seconds, bytes
+    read, bytes written) in the Prometheus text format, labelled with the
+    name of the run, the device it is on and the stage. The throughput of
+    every stage is exported as well, from the larger of the bytes read and
+    written.
+    """
+    devices = {}
+    labels = []
+    for row in rows:
+        if row[0] not in devices:
+            devices[row[0]] = run_device(row[0])
+        labels.append("{{run=\"{}\",device=\"{}\",stage=\"{}\"}}".format(
+            label_value(os.path.basename(row[0]) or row[0]),
+            devices[row[0]], label_value(row[1])))
+    lines = []
+    for index, (metric, metric_type, text) in enumerate(EXPORTED):
+        lines.append("# HELP {} {}".format(metric, text))
+        lines.append("# TYPE {} {}".format(metric, metric_type))
+        for label, row in zip(labels, rows):
+            lines.append("{}{} {}".format(metric, label, row[index + 2]))
+    lines.append("# HELP run_combiner_stage_bytes_per_second Average "
+                 "throughput of the stage.")
+    lines.append("# TYPE run_combiner_stage_bytes_per_second gauge")
+    for label, row in zip(labels, rows):
+        if row[3] > 0:
+            lines.append("run_combiner_stage_bytes_per_second{} {:.1f}"
+                         .format(label, max(row[5], row[6]) / row[3]))
+    lines.append("# HELP run_combiner_metrics_updated_seconds When these "
+                 "metrics were written.")
+    lines.append("# TYPE run_combiner_metrics_updated_seconds gauge")
+    lines.append("run_combiner_metrics_updated_seconds {:.0f}".format(time()))
+    return "\n".join(lines) + "\n"
+
+def write_textfile(path, rows):
+    """
+    Write rows (see prometheus_text) to path. The file is written under a
+    temporary name and renamed into place, so that the node exporter never
+    reads half of it.
+    """
+    tmp_path = "{}.{}.tmp".format(path, os.getpid())
+    with open(tmp_path, "w") as textfile:
+        textfile.write(prometheus_text(rows))
+    os.rename(tmp_path, path)
@@ -0,0 +1,127 @@
+"""
+Mail transports used by the run combiner to send its notifications. This
+script is not meant to be called as a standalone script, rather it is called
+from the run combiner script.
+
+The transports are:
+
+sendmail: pipes every message to /usr/sbin/sendmail (the default).
+smtp:     sends every message to the SMTP server at smtp_host:smtp_port. A
+          local debugging server can stand in for a real one, for example
+          python -m smtpd -n -c DebuggingServer localhost:1025, or
+          python -m aiosmtpd -n -l localhost:1025 on newer pythons.
+file:     writes every message as a .eml file to sink_folder, for testing.
+
+The notifications about one run for one address are sent together, as one
+digest message (see digest_message).
+"""
+
+import os
+import errno
+import subprocess
+from time import time
+
+SENDER = "st-analysis-server@scilifelab.se"
+
+def make_message(subject, message, address):
+    # The email package, and smtplib below, are imported when they are first
+    # needed, as they take longer to import than most runs take to check.
+    from email.mime.text import MIMEText
+    msg = MIMEText(message)
+    msg["From"] = SENDER
+    msg["To"] = address
+    msg["Subject"] = subject
+    return msg
+
+def digest_message(run, address, notes):
+    """
+    Return one message to address with all the notes, in the form [(subject,
+    message)], about run. A single note is sent as it is.
+    """
+    if len(notes) == 1:
+        return make_message(notes[0][0], notes[0][1], address)
+    subject = "{} messages about {}".format(
+        len(notes), os.path.basename(run) if run else "the run combiner")
+    sections = ["{}\n{}\n{}".format(note_subject, "-" * len(note_subject),
+                                    note_message)
+                for note_subject, note_message in notes]
+    return make_message(subject, "\n\n".join(sections), address)
+
+class SendmailTransport(object):
+
+    def __init__(self, path="/usr/sbin/sendmail"):
+        self.path = path
+
+    def send(self, msg):
+        p = subprocess.Popen([self.path, "-t", "-oi"], stdin=subprocess.PIPE)
+        p.communicate(msg.as_string().encode("utf-8"))
+        if p.returncode != 0:
+            raise IOError("sendmail exited with status {}."
+                          .format(p.returncode))
+
+class SMTPTransport(object):
+
+    def __init__(self, host="localhost", port=25):
+        self.host = host
+        self.port = port
+
+    def send(self, msg):
+        import smtplib
+        try:
+            server = smtplib.SMTP(self.host, self.port, timeout=60)
+            try:
+                server.sendmail(msg["From"], [msg["To"]], msg.as_string())
+            finally:
+                server.quit()
+        except smtplib.SMTPException as e:
+            raise IOError("SMTP error: {}".format(e))
+
+class FileTransport(object):
+    """
+    Write every message to its own file in folder, under a temporary name
+    that is renamed when the file is complete.
+    """
+
+    def __init__(self, folder):
+        self.folder = folder
+        self.sent = 0
+
+    def send(self, msg):
+        try:
+            os.makedirs(self.folder)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        self.sent += 1
+        name = "{:.6f}-{}-{}.eml".format(time(), os.getpid(), self.sent)
+        tmp_path = os.path.join(self.folder, "." + name)
+        with open(tmp_path, "w") as f:
+            f.write(msg.as_string())
+        os.rename(tmp_path, os.path.join(self.folder, name))
+
+TRANSPORT = [SendmailTransport()]
+
+def open_transport(section):
+    """
+    Return the transport set up in the email section of the config file.
+    """
+    transport = section.get("transport", "sendmail")
+    if transport == "smtp":
+        return SMTPTransport(section.get("smtp_host", "localhost"),
+                             section.get("smtp_port", 25))
+    if transport == "file":
+        return FileTransport(section["sink_folder"])
+    return SendmailTransport()
+
+def set_transport(transport):
+    """
+    Change the transport that deliver sends messages with.
+    """
+    TRANSPORT[0] = transport
+
+def deliver(msg):
+    """
+    Send msg with the current transport. Raises an IOError or OSError if it
+    could not be sent.
+    """
+    TRANSPORT[0].send(msg)
@@ -5,37 +5,247 @@ The format of the config file should be as follows:
 
 email:
     admin: email address
+    use_ss_email: yes
+    transport: sendmail
+    max_attempts: 3
+    retry_seconds: 300
 runs:
     runs_folder: /path/to/input_folders
     in_folder: input_folder_name
     out_folder: output_folder_name
     keep_original_files: yes
+    merge_mode: concat
+    incremental: no
+    expected_lanes: 4
+    count_records: no
+    output_md5: no
+    link_single_lane: yes
 logging:
     log_file_name: path/to/log_file
 verify_transfer:
     use_md5: yes
-    md5_path: /usr/local/bin/md5sum
+    md5_workers: 4
+    stop_at_first_mismatch: no
+    verify_during_merge: no
 users:
     run_script: st.bioinfo
 database:
     name: ST_Run_Combiner
     table_name: ST_Run_Combiner_Data
     location: /home/st.bioinfo/SQLite
+    shared: no
+daemon:
+    settle_seconds: 60
+    retry_seconds: 3600
+    poll_seconds: 60
+scheduler:
+    max_workers: 4
+    max_io_jobs: 2
+    space_margin_percent: 5
+    recompress_ratio: 1.1
+    heartbeat_seconds: 30
+    stale_seconds: 300
+    max_attempts: 3
+compression:
+    backend: auto
+    level: 6
+    threads: 4
+    bgzf: no
+    buffer_mb: 16
+metrics:
+    textfile: /var/lib/node_exporter/textfile/run_combiner.prom
+    window_hours: 24
+
+merge_mode is optional. "concat" (the default) joins the gzipped lane files
+byte for byte into a multi-member gzip file, "recompress" decompresses the lane
+files and compresses the merged file again, for tools that cannot read
+multi-member gzip files. The merged file is written as a single gzip member
+(BGZF files are made of many members by design). The builtin compression
+backend (which auto stands for) can checkpoint it after every lane file;
+pigz and gzip are given all the lane files of a merged file through one
+process, so a merge with them that is interrupted starts again from the
+first lane file, and in incremental mode it waits for the last one.
+
+A sample and read with a single lane file is not copied at all in concat
+mode: link_single_lane (on by default in concat mode, off in recompress mode)
+clones the lane file to the output where the filesystem can (btrfs, XFS with
+reflinks), and otherwise hard links it, so the merged file costs no space
+until the lane file is deleted. When the input files are not kept a hard
+link is tried first. The output is only copied if it is on another
+filesystem, or with count_records. On filesystems that can clone, the first
+lane file of a larger merge is cloned too, and the others are appended with
+copy_file_range. In recompress mode, link_single_lane keeps single lane files
+as they are instead of recompressing them.
+
+The compression section is optional and only used with merge_mode recompress.
+backend is one of auto (builtin), builtin, pigz or gzip (see
+compression.py), bgzf writes BGZF files that aligners can seek into (builtin
+backend only).
+The lane files are decompressed and compressed again as one stream without
+writing an uncompressed copy to disk; buffer_mb sets how much data is read
+and decompressed at a time, which bounds the memory used per merge.
+
+The daemon section is optional and only used when the script is started with
+--daemon. The script then keeps running and watches the runs folder with
+inotify (or, where that is not available, by checking it every poll_seconds).
+A run is merged as soon as its files have not changed for settle_seconds and,
+with use_md5, its md5sums.txt is there. Runs that could not be merged are tried
+again when they change or after retry_seconds, and so are the runs of a pass
+that stopped with an error, which is mailed to the admin. poll_seconds must be
+greater than 0.
+
+The state of every run (Verifying, Waiting, Merging, Failed or Completed) and
+of every merged file is kept in the database. A .completed file left in the
+runs folder by older versions of the script is imported into the database the
+first time the script runs.
+
+Merged files are written to a .part file next to the output, and the database
+records which input files have been appended to it and how large it was after
+the last of them. If the script is stopped in the middle of a merge, or an
+input file turns out not to match md5sums.txt, the next attempt cuts the .part
+file back to that size and carries on with the next input file instead of
+starting again. The .part file is only thrown away when it does not match
+what the database recorded.
+
+With incremental, a run is merged lane by lane while it is still being
+transferred. Every lane file is merged as soon as it matches its line in
+md5sums.txt or, when timestamps are used, is two hours old, as long as all the
+lanes before it have been merged. The merged file of a sample and read is
+finished when all of its lane files are in: those listed in md5sums.txt or, with
+timestamps, those of the lanes the sample is on in the Lane column of the
+sample sheet and at least expected_lanes of them. With timestamps, if the
+sample sheet has no Lane column and expected_lanes is not set, the merged
+files are never finished.
+
+The scheduler section is optional. max_workers is the number of merges run at
+the same time (default 1), max_io_jobs caps how many of them may work on the
+same filesystem at once (default max_workers). A merge is only started when
+its output, estimated from the size of its input files (times
+recompress_ratio, default 1.1, with merge_mode recompress), fits on the disk
+with space_margin_percent (default 5) of the disk to spare. Other merges wait
+for space to be freed, or for the next pass.
+
+Several copies of the script can work on the same runs folder. A run that is
+being worked on is locked with a lock file in .run_combiner_locks in the runs
+folder, and its heartbeat in the database is updated every heartbeat_seconds
+(default 30) of the scheduler section. A run whose heartbeat is older than
+stale_seconds (default 300), or whose process has died on this host, is
+merged again by the next copy of the script that looks at it.
+
+This also works across several servers that mount the same runs folder and
+share the database, if shared is set in the database section. The database
+is then kept with a rollback journal instead of in WAL mode, which SQLite
+only supports with every connection on one host, and the filesystem it is on
+must support POSIX (fcntl) locks, as NFSv4 does.
+
+The copy of the script that verifies a run puts one merge job per sample and
+read in the job table of the database. Every copy then claims queued jobs from
+the table, of any run, one at a time, until none are left, and whoever finishes
+the last job of a run marks it as completed and sends the email. A job that
+fails is queued again until it has been tried max_attempts times (default 3),
+and a job whose heartbeat stops is queued again as well. --node sets the name a
+copy of the script is known by in the database (the host name by default), so
+that several copies on one machine can stand in for separate servers.
+
+The md5 sums in md5sums.txt are checked in-process on md5_workers threads
+(default 4). With stop_at_first_mismatch the check gives up on a run as soon
+as one file does not match. With verify_during_merge the separate md5 check
+is skipped; instead every file is hashed while it is read for merging, and a
+merged file is only kept if all of its input files match md5sums.txt.
+Files that passed the md5 check are remembered in the database, and are not
+hashed again by later runs of the script unless they change.
+
+Input files are deleted (unless keep_original_files is set) and emails are
+sent by a background stage, so that the merges never wait for either. The
+input files of a merged file are only deleted, in-process, once the merged
+file has been checked against what the database recorded while merging it:
+its size, the lane files merged into it and, with count_records, its record
+counts. Emails are collected during a pass and sent at the end of it, one
+per run and address. Every deletion and email is recorded in the post table
+of the database, with its attempts and errors, and is tried again after
+retry_seconds until it has been tried max_attempts times (default 3).
+transport is sendmail (the default), smtp, which sends to smtp_host and
+smtp_port (for example a local debugging SMTP server), or file, which writes
+every email to sink_folder (see notify.py).
+
+With count_records, the records and bases of every lane file are counted
+while it is merged, and a lane file that does not end with a whole fastq
+record is not merged. The counts of every lane file, and their totals for
+every merged file, are kept in the job table of the database. With
+output_md5, the md5 sum of every merged file is computed from the data
+written to it and, when the run is completed, written to md5sums.txt in
+out_folder. In concat mode either of them means the gzipped data is read
+through python (and decompressed, for count_records) instead of being copied
+in the kernel. With the pigz and gzip backends, the compressed output is
+read back from the page cache to be hashed.
+
+The time, CPU time and bytes read and written of every stage (scan, verify,
+sample_sheet, concat, link, decompress, compress, delete and notify) are
+recorded for every run and merged file in the metrics table of the database
+(see metrics.py). The metrics section is optional. With textfile, the totals
+per run and stage of the runs worked on in the last window_hours (default 24)
+are written to that file after every pass, in the Prometheus text format read
+by the textfile collector of the node exporter.
+
+Without a command, or with merge, the script verifies and merges every run
+in the runs folder that is not completed. --run limits it to the named runs,
+and --sample to the merge jobs of the named samples (by S number, as in S1,
+or by the sample name in the file names); the other jobs of those runs stay
+queued for the next pass. The other commands only report, without merging
+anything: plan lists the merge jobs that would run, with the size of their
+input, the estimated size of their output and the estimated time, from the
+merges recorded in the metrics table; verify checks the transfer of the runs
+as a merge would, and exits with status 1 if any is not ready; status shows
+the state of the runs, their jobs and pending deletions and emails in the
+database. For example:
+
+python run_combiner.py --config_file config.yaml plan
+python run_combiner.py --config_file config.yaml merge --run BT23268 --sample S1
+python run_combiner.py --config_file config.yaml status --run BT23268
 """
 
 import sys
+import errno
+import fcntl
 import argparse
-import re
+import csv
 import os
-import subprocess
-import glob
 import logging
+import threading
 import yaml
 import sqlite3
-from email.mime.text import MIMEText
+import hashlib
+import uuid
+from stat import S_ISREG
+from subprocess import CalledProcessError
 from time import strftime, gmtime, time
-from matplotlib.compat.subprocess import CalledProcessError
 from check_config_file import check_config
+from compression import (compression_settings, finish_output,
+                         open_compressor, thread_pool)
+from run_index import (ScanStats, group_files, index_run, list_runs,
+                       parse_fastq_name)
+from liveness import (Heartbeat, RunLock, node_name, process_alive,
+                      set_node_name)
+from metrics import METRICS, Timer, measure, write_textfile
+from integrity import (FastqCounter, GzipStream, HashingWriter, OutputDigest,
+                       Tee)
+from notify import (deliver, digest_message, make_message, open_transport,
+                    set_transport)
+from admission import DiskBudget, estimate_output
+
+COPY_BUFFER_SIZE = 16 * 1024 * 1024
+# ioctl that makes a file share the data blocks of another (a reflink), on
+# Linux filesystems with copy-on-write support such as btrfs and XFS.
+FICLONE = 0x40049409
+DB_COLUMNS = ("Run_ID", "Process_ID", "Status", "Email", "Name", "Updated",
+              "Host", "Heartbeat")
+DB_LOCK = threading.Lock()
+# The PostMerge stage of the current pass, if one is running (see
+# process_runs).
+POST_MERGE = [None]
+HASH_BUFFER_SIZE = 8 * 1024 * 1024
+SAMPLE_SHEETS = {}
+SETTLED_SECONDS = 7200
 
 def check(dirPath, name):
     """
@@ -49,101 +259,196 @@ def check(dirPath, name):
     else:
         return False
 
-def send_mail(subject, message, address):
+def file_size(path):
+    """
+    Return the size of the file at path, or None if there is no such file.
+    Tells whether a file exists and how big it is with a single stat.
+    """
+    try:
+        result = os.stat(path)
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            raise
+        return None
+    return result.st_size if S_ISREG(result.st_mode) else None
+
+def send_mail(subject, message, address, run=""):
     """
-    Send email from python.
+    Send email from python. While a PostMerge stage is running, the message
+    is queued there instead, and sent at the end of the pass together with
+    the other messages about run to address.
     """
-    msg = MIMEText(message)
-    msg["From"] = "st-analysis-server@scilifelab.se"
-    msg["To"] = address
-    msg["Subject"] = subject
-    p = subprocess.Popen(["/usr/sbin/sendmail", "-t", "-oi"],
-                         stdin=subprocess.PIPE)
-    p.communicate(msg.as_string())
+    if POST_MERGE[0] is not None:
+        POST_MERGE[0].notify(run, address, subject, message)
+        return
+    msg = make_message(subject, message, address)
+    with measure("notify", run) as stage:
+        deliver(msg)
+        stage.bytes_written = len(msg.as_string())
     logging.info("Email sent to {}".format(address))
 
 def list_dir_no_hidden(dirPath):
     """
     Return all non-hidden folders (no dot folders).
     """
-    allPaths = []
-    for fname in os.listdir(dirPath):
-        path = os.path.join(dirPath, fname)
-        if os.path.isdir(path):
-            if not fname.startswith("."):
-                allPaths.append(path)
-    return allPaths
+    return list_runs(dirPath)
 
-def get_completed(dirPath):
+def get_completed(connection, table_name):
     """
     Get the completed runs before we start so that 
     we don't try to process any run twice.
     """
-    with open(os.path.join(dirPath,".completed"), "r") as f:
-        completed_runs = [ line.strip() for line in f]
-    return completed_runs
-
+    return set(row[0] for row in select_from_db(connection, table_name, 
+                                                "Status", "Completed", 
+                                                "WHERE"))
 
-def update_completed(completed_dir, dirPath):
+def get_run_statuses(connection, table_name):
     """
-    Update the completed runs list.
+    Return the status of every run in the database as {Run_ID: Status}.
     """
-    with open(os.path.join(dirPath,".completed"), "a") as f:
-        f.write(completed_dir + "\n")
+    with DB_LOCK:
+        return dict(connection.execute("SELECT Run_ID, Status FROM {}"
+                                       .format(table_name)).fetchall())
 
-def check_md5(currentDir,md5_path):
+def read_md5sums(currentDir):
     """
-    Check the md5 hash to make sure the files are fully transferred.
+    Parse the md5sums.txt file in currentDir into a dictionary in the form
+    {file name: md5 hex digest}.
     """
-    logging.info("Checking the md5 status of files in {}".format(currentDir))
-    md5Status = subprocess.Popen([md5_path, "-c", "md5sums.txt"],
-                                 cwd=currentDir)
-    md5Status.wait()
-    return md5Status.returncode
+    md5sums = {}
+    with open(os.path.join(currentDir, "md5sums.txt"), "r") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            digest, name = line.split(None, 1)
+            md5sums[name.lstrip("*")] = digest.lower()
+    return md5sums
 
-def check_timestamps(current_dir,time_):
-    file_list = files_to_be_merged(current_dir)
-    fails_ = 0
-    for file_ in file_list:
-        mtime = os.path.getmtime(os.path.join(current_dir,file_))
-        if (time_ - mtime) < 7200:
-            fails_ += 1
-    return fails_
-    
-def files_to_be_merged(currentDir):
+def write_md5sums(currentDir, md5sums):
     """
-    Return a list of all the files in a directory that are to be merged.
+    Add md5sums ({file name: md5 hex digest}) to the md5sums.txt file in
+    currentDir, in the format md5sum -c reads. The file is replaced in one
+    step, so a reader never sees half of it.
     """
-    return glob.glob1(currentDir, "*.gz")
+    try:
+        entries = read_md5sums(currentDir)
+    except (IOError, ValueError):
+        entries = {}
+    entries.update(md5sums)
+    path = os.path.join(currentDir, "md5sums.txt")
+    tmp_path = "{}.{}.tmp".format(path, os.getpid())
+    with open(tmp_path, "w") as f:
+        for name in sorted(entries):
+            f.write("{}  {}\n".format(entries[name], name))
+    os.rename(tmp_path, path)
 
+def hash_file(path, stop=None):
+    """
+    Return the md5 hex digest of the file at path, reading it in large
+    blocks. If the threading.Event stop is set while hashing, give up and
+    return None.
+    """
+    md5 = hashlib.md5()
+    buf = bytearray(HASH_BUFFER_SIZE)
+    view = memoryview(buf)
+    with open(path, "rb") as f:
+        while True:
+            if stop is not None and stop.is_set():
+                return None
+            n = f.readinto(buf)
+            if not n:
+                return md5.hexdigest()
+            md5.update(view[:n])
 
-def group_samples(currentDir, files):
+def check_md5(currentDir, max_workers=4, stop_early=False, cache=None,
+              stats=None):
     """
-    Return a list of files that are to be merged into one file. This method
-    takes as input a list of all the .gz files in a directory and returns a 
-    dictionary in the form {directory: [file list]} where [file list] is all 
-    the files to be merged into one file.
+    Check the md5 hash to make sure the files are fully transferred. The
+    files listed in md5sums.txt are hashed concurrently on max_workers
+    threads. Returns a dictionary in the form {file name: status}, where the
+    status is one of OK, FAILED, MISSING or NOT CHECKED. With stop_early the
+    remaining files are left NOT CHECKED as soon as one file does not match.
+    An empty dictionary is returned if md5sums.txt can not be read.
+    
+    cache is a dictionary in the form {path: (size, mtime, inode, digest)}
+    of files that were verified earlier (see load_md5_cache). Files whose
+    size, mtime and inode are unchanged and whose digest still matches
+    md5sums.txt are not hashed again. Files that pass are added to cache.
+    stats is a dictionary in the form {path: (size, mtime, inode)} of files
+    that were already stat'ed (see RunIndex.stat_cache); other files are
+    stat'ed here.
     """
-    merge_list = {}
-    read1 = []
-    read2 = []
-    samples = {}
-    for one_file in files:
-        sample = re.search("_(S\d+)_", one_file)
-        samples.setdefault(sample.group(1), []).append(one_file)
-        
-    for key in samples:
-        temp_read1=[]
-        temp_read2 =[]
-        for value in samples[key]:
-            if re.search("_R1_", value):
-                temp_read1.append(value)
+    logging.info("Checking the md5 status of files in {}".format(currentDir))
+    try:
+        md5sums = read_md5sums(currentDir)
+    except (IOError, ValueError):
+        logging.error("Could not read md5sums.txt in {}".format(currentDir),
+                      exc_info = True)
+        return {}
+    if cache is None:
+        cache = {}
+    stop = threading.Event()
+    
+    def verify(name):
+        path = os.path.join(currentDir, name)
+        try:
+            if stats is not None and path in stats:
+                identity = stats[path]
             else:
-                temp_read2.append(value)
-        read1.append(temp_read1)
-        read2.append(temp_read2)
-    merge_list[currentDir[0]] = (read1,read2)    
-    return merge_list
+                stat = os.stat(path)
+                identity = (stat.st_size, stat.st_mtime, stat.st_ino)
+            if cache.get(path) == identity + (md5sums[name],):
+                return (name, "OK")
+            digest = hash_file(path, stop)
+        except (IOError, OSError):
+            digest = "missing"
+        if digest is None:
+            return (name, "NOT CHECKED")
+        if digest == md5sums[name]:
+            cache[path] = identity + (digest,)
+            return (name, "OK")
+        if stop_early:
+            stop.set()
+        return (name, "MISSING" if digest == "missing" else "FAILED")
+    
+    pool = thread_pool(max_workers)
+    try:
+        results = dict(pool.map(verify, sorted(md5sums)))
+    finally:
+        pool.close()
+        pool.join()
+    for name in sorted(results):
+        if results[name] in ("FAILED", "MISSING"):
+            logging.warning("md5 check of {} in {}: {}".format(
+                name, currentDir, results[name]))
+    return results
+
+def hashed_bytes(currentDir, results, cache, stats):
+    """
+    Return how many bytes check_md5 read to get results, given the cache it
+    was called with (before it was updated) and the stat results of the
+    files. Files that were found in the cache were not read.
+    """
+    total = 0
+    for name, status in results.items():
+        path = os.path.join(currentDir, name)
+        if (status in ("OK", "FAILED") and path in stats and
+                tuple(cache.get(path, ())[:3]) != tuple(stats[path])):
+            total += stats[path][0]
+    return total
+
+def check_timestamps(run_index,time_):
+    """
+    Return how many of the gzipped files in run_index (see
+    run_index.index_run) were changed less than two hours before time_.
+    """
+    fails_ = 0
+    for file_ in run_index.fastq_names():
+        mtime = run_index.files[file_].mtime
+        if (time_ - mtime) < SETTLED_SECONDS:
+            fails_ += 1
+    return fails_
 
 def check_permissions(currentDir):
     """
@@ -154,33 +459,503 @@ def check_permissions(currentDir):
     return (currentDir, False)
 
 
-def merge_files(currentDir, samples, keep_samples, email_address, in_folder,
-                out_folder, ss_info):
+def copy_fd(in_fd, out_fd, md5=None):
+    """
+    Copy everything from in_fd to out_fd, starting at the current offset of
+    both. The copy is done in the kernel with copy_file_range or sendfile
+    where the platform supports it, otherwise with large buffered reads.
+    If md5 is given, the data has to pass through python anyway, so it is
+    always copied with buffered reads and added to the md5 hash on the way.
+    Returns the number of bytes copied.
+    """
+    copied = 0
+    for method in ("copy_file_range", "sendfile"):
+        kernel_copy = getattr(os, method, None)
+        if kernel_copy is None or md5 is not None:
+            continue
+        try:
+            while True:
+                if method == "copy_file_range":
+                    sent = kernel_copy(in_fd, out_fd, COPY_BUFFER_SIZE)
+                else:
+                    sent = kernel_copy(out_fd, in_fd, None, COPY_BUFFER_SIZE)
+                if sent == 0:
+                    return copied
+                copied += sent
+        except OSError as e:
+            if e.errno not in (errno.EXDEV, errno.ENOSYS, errno.EINVAL,
+                               errno.EOPNOTSUPP, errno.EBADF):
+                raise
+    while True:
+        chunk = os.read(in_fd, COPY_BUFFER_SIZE)
+        if not chunk:
+            return copied
+        if md5 is not None:
+            md5.update(chunk)
+        view = memoryview(chunk)
+        while view:
+            written = os.write(out_fd, view)
+            view = view[written:]
+        copied += len(chunk)
+
+def clone_fd(in_fd, out_fd):
+    """
+    Make the file out_fd is open on share the data blocks of the file in_fd
+    is open on, replacing whatever it held, without copying any data (see
+    FICLONE). Returns False if the filesystem can not do that.
+    """
+    try:
+        fcntl.ioctl(out_fd, FICLONE, in_fd)
+    except (IOError, OSError) as e:
+        if e.errno not in (errno.EXDEV, errno.ENOSYS, errno.EINVAL,
+                           errno.EOPNOTSUPP, errno.ENOTTY, errno.EBADF,
+                           errno.EPERM):
+            raise
+        return False
+    return True
+
+def place_file(path, out_path, methods=("reflink", "hardlink")):
+    """
+    Make out_path hold the same data as path without copying it, with the
+    first of methods that works here: "reflink" clones path (see clone_fd),
+    "hardlink" links out_path to the same inode as path. Returns the method
+    that was used, or None if none of them work, for example because
+    out_path is on another filesystem.
+    """
+    for method in methods:
+        if method == "hardlink":
+            try:
+                os.link(path, out_path)
+                return method
+            except OSError as e:
+                if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK,
+                                   errno.EOPNOTSUPP):
+                    raise
+            continue
+        tmp_path = out_path + ".part"
+        in_fd = os.open(path, os.O_RDONLY)
+        try:
+            out_fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC,
+                             0o644)
+            try:
+                cloned = clone_fd(in_fd, out_fd)
+                if cloned:
+                    os.fsync(out_fd)
+            finally:
+                os.close(out_fd)
+        finally:
+            os.close(in_fd)
+        if cloned:
+            os.rename(tmp_path, out_path)
+            return method
+        os.remove(tmp_path)
+    return None
+
+def check_digest(sample, md5, md5sums):
+    """
+    Raise an IOError if the md5 hash computed for sample while merging does
+    not match the one listed for it in md5sums.txt.
+    """
+    if md5sums.get(sample) != md5.hexdigest():
+        raise IOError("The md5 sum of {} does not match md5sums.txt. The file "
+                      "is still copying or was corrupted.".format(sample))
+
+def decompress_into(infile, write, buffer_size, md5=None):
+    """
+    Decompress the gzip file infile (which may have several members) and pass
+    the decompressed data to write, at most buffer_size bytes at a time. If
+    md5 is given, the compressed data is added to the md5 hash as it is read.
+    """
+    stream = GzipStream(write, buffer_size)
+    for chunk in iter(lambda: infile.read(buffer_size), b""):
+        if md5 is not None:
+            md5.update(chunk)
+        stream.update(chunk)
+    stream.finish(infile.name)
+
+def resume_point(tmp_path, samples, checkpoint):
+    """
+    Return how many of the files in samples are already in the partial
+    output tmp_path, according to checkpoint. If the partial output does not
+    match the checkpoint, the checkpoint is reset and 0 is returned so that
+    the output is made again from the start.
+    """
+    if checkpoint is None or not checkpoint.lanes:
+        return 0
+    if (checkpoint.lanes == samples[:len(checkpoint.lanes)] and
+            os.path.isfile(tmp_path) and
+            os.path.getsize(tmp_path) >= checkpoint.offset):
+        logging.info("Resuming {} after {} ({} bytes).".format(
+            tmp_path, checkpoint.lanes[-1], checkpoint.offset))
+        return len(checkpoint.lanes)
+    logging.warning("The partial output {} does not match its checkpoint, "
+                    "starting it again.".format(tmp_path))
+    checkpoint.save([], 0)
+    return 0
+
+def metrics_key(infolder, out_path):
+    """
+    Return the run and the name of the merged file that the stages of a merge
+    from infolder to out_path are recorded under (see metrics.measure).
+    """
+    return (os.path.dirname(infolder),
+            os.path.splitext(os.path.basename(out_path))[0])
+
+def merge_lanes(infolder, samples, out_path, append_lane, finish=None,
+                checkpoint=None, final=True, digest=None, stream=None,
+                resumable=True):
+    """
+    Append the files in samples to out_path one after the other, by calling
+    append_lane(path, outfile) for each of them, and finish(outfile) at the
+    end. The output is written under a temporary name and only renamed to
+    out_path when it is complete.
+    
+    append_lane may return a FastqCounter (see integrity.py) with the records
+    and bases it appended. A file that does not end with a whole record is
+    not merged. If every file was counted, the totals of the merged file are
+    the sum of the counts of its files. digest is an OutputDigest of the
+    temporary file, or None; the md5 sum of the merged file is taken from it.
+    The counts and md5 sum are saved in checkpoint and logged.
+    
+    With a checkpoint (see JobCheckpoint), the files appended so far and the
+    size of the output are recorded after every file. A merge that was
+    interrupted carries on after the last file that was fully appended, and
+    if appending a file fails the partial output is cut back to the last
+    checkpoint and kept for the next attempt. Without a checkpoint the partial
+    output is removed when something goes wrong.
+    
+    If final is False, more files will be added to samples later (see
+    plan_incremental_run), so the partial output is left in place, with its
+    checkpoint, instead of being finished and renamed.
+    
+    stream is a one item list that holds the state of the compressed stream
+    being written (see compression.open_compressor), which append_lane and
+    finish keep up to date. It is saved with every checkpoint and restored
+    when a merge carries on. The checkpoint of the finished output is saved
+    before it is renamed, so a merge that stops in between is not finished
+    twice.
+    
+    If resumable is False, the output cannot be carried on from the middle
+    (an external compression program holds the end of it), so the checkpoint
+    is only saved once the output is finished, and a merge that was
+    interrupted before that starts again from the first file.
+    """
+    tmp_path = out_path + ".part"
+    done = resume_point(tmp_path, samples, checkpoint)
+    finished = bool(done) and checkpoint.stream_state == "finished"
+    if done and not resumable and not finished:
+        logging.info("{} cannot be resumed, starting it again."
+                     .format(tmp_path))
+        checkpoint.save([], 0)
+        done = 0
+    counts = list(checkpoint.counts[:done]) if done else []
+    if stream is not None:
+        stream[0] = checkpoint.stream_state if done and not finished else None
+    if done:
+        outfile = open(tmp_path, "r+b")
+        outfile.truncate(checkpoint.offset)
+        outfile.seek(checkpoint.offset)
+    else:
+        outfile = open(tmp_path, "wb")
+    try:
+        if digest is not None:
+            digest.catch_up(outfile)
+        for index in range(done, len(samples)):
+            logging.info("Merging sample {}...".format(samples[index]))
+            counter = append_lane(os.path.join(infolder, samples[index]),
+                                  outfile)
+            if counter is not None and not counter.complete():
+                raise IOError("{} does not end with a whole fastq record."
+                              .format(samples[index]))
+            counts.append(None if counter is None else 
+                          (counter.records, counter.bases))
+            outfile.flush()
+            if digest is not None:
+                digest.catch_up(outfile)
+            if checkpoint is not None and resumable:
+                os.fsync(outfile.fileno())
+                checkpoint.save(samples[:index + 1],
+                                os.fstat(outfile.fileno()).st_size, counts,
+                                stream[0] if stream is not None else None)
+            logging.info("Merging for sample {} finished at {}.".format(
+                    samples[index],strftime("%H:%M:%S, %A, %B %d, %Y",
+                                            gmtime())))
+        if final and finish is not None and not finished:
+            finish(outfile)
+        outfile.flush()
+        if digest is not None:
+            digest.catch_up(outfile)
+        os.fsync(outfile.fileno())
+        if final and checkpoint is not None:
+            checkpoint.save(samples, os.fstat(outfile.fileno()).st_size, 
+                            counts, "finished")
+    except Exception:
+        try:
+            outfile.close()
+        except (IOError, OSError):
+            pass
+        if checkpoint is None:
+            os.remove(tmp_path)
+        else:
+            with open(tmp_path, "r+b") as partial:
+                partial.truncate(checkpoint.offset)
+        raise
+    outfile.close()
+    if not final:
+        return
+    os.rename(tmp_path, out_path)
+    totals = lane_totals(counts)
+    if totals is not None:
+        logging.info("{} holds {} records with {} bases, from {} files."
+                     .format(out_path, totals[0], totals[1], len(counts)))
+    output_md5 = digest.hexdigest() if digest is not None else None
+    if checkpoint is not None:
+        checkpoint.save_output(totals, output_md5)
+
+def lane_totals(counts):
+    """
+    Return the (records, bases) totals of the lane files with the given
+    counts, or None if any of them was not counted.
+    """
+    if not counts or None in counts:
+        return None
+    return (sum(count[0] for count in counts),
+            sum(count[1] for count in counts))
+
+def lane_counter(count):
+    """
+    Return a new FastqCounter if records are counted, otherwise None.
+    """
+    return FastqCounter() if count else None
+
+def concat_files(infolder, samples, out_path, md5sums=None, checkpoint=None,
+                 final=True, count=False, output_md5=False):
+    """
+    Join the gzipped files in samples into out_path byte for byte. Gzip files
+    that are concatenated are still a valid (multi-member) gzip file, so
+    nothing has to be decompressed or compressed again. If md5sums is given,
+    every file is checked against it while it is copied, and nothing is
+    written to out_path if any of them do not match. With count, the data is
+    decompressed on the way to count its records and bases, and with
+    output_md5 the md5 sum of out_path is computed from the data copied (see
+    merge_lanes). Either makes the data pass through python instead of being
+    copied in the kernel. Otherwise the first file is cloned into the empty
+    output where the filesystem supports it (see clone_fd), and the others
+    are appended with copy_file_range, which copy-on-write filesystems can
+    also do by sharing blocks rather than copying them.
+    """
+    run, name = metrics_key(infolder, out_path)
+    digest = OutputDigest(out_path + ".part") if output_md5 else None
+    
+    def append_lane(path, outfile):
+        md5 = hashlib.md5() if md5sums is not None else None
+        counter = lane_counter(count)
+        stream = GzipStream(counter.count) if counter is not None else None
+        with measure("concat", run, name) as stage:
+            in_fd = os.open(path, os.O_RDONLY)
+            try:
+                if (md5 is None and stream is None and digest is None and
+                        os.fstat(outfile.fileno()).st_size == 0 and
+                        clone_fd(in_fd, outfile.fileno())):
+                    # Nothing was read or written, only the file's blocks
+                    # are shared.
+                    outfile.seek(0, os.SEEK_END)
+                else:
+                    copied = copy_fd(in_fd, outfile.fileno(), 
+                                     Tee(md5, stream, digest) 
+                                     if count or output_md5 else md5)
+                    stage.bytes_read = stage.bytes_written = copied
+            finally:
+                os.close(in_fd)
+        if stream is not None:
+            stream.finish(os.path.basename(path))
+        if md5 is not None:
+            check_digest(os.path.basename(path), md5, md5sums)
+        return counter
+    
+    merge_lanes(infolder, samples, out_path, append_lane,
+                checkpoint=checkpoint, final=final, digest=digest)
+
+def recompress_files(infolder, samples, out_path, compression, md5sums=None,
+                     checkpoint=None, final=True, count=False, 
+                     output_md5=False):
+    """
+    Decompress the gzipped files in samples one after the other and stream
+    the data straight into the compression backend in compression, so that
+    no uncompressed copy of the merged file is written to disk. The builtin
+    backend carries one gzip member on from file to file, and the state of
+    its stream is saved with the checkpoint. pigz and gzip are given all the
+    files through a single process, so that they also write one member, but
+    the output can then only be checkpointed once it is finished (see
+    merge_lanes); for the same reason an output that is not final is left
+    until all its files are there. If md5sums is given, every file is checked
+    against it while it is read, and nothing is written to out_path if any
+    of them do not match. With count, the records and bases are counted as
+    they are compressed, and with output_md5 the md5 sum of out_path is
+    computed (see merge_lanes). The output of the builtin backend is hashed
+    as it is written; that of pigz and gzip is read back from the page cache
+    as it comes in.
+    
+    The time spent handing data to the compressor is recorded as the
+    compress stage, and the rest as the decompress stage. The CPU time of
+    compression threads and programs is not included.
+    """
+    run, name = metrics_key(infolder, out_path)
+    external = compression["backend"] != "builtin"
+    if external and not final:
+        logging.info("{} will be compressed by {} once all its files are in."
+                     .format(out_path, compression["backend"]))
+        return
+    digest = OutputDigest(out_path + ".part") if output_md5 else None
+    stream = [None]
+    compressors = [None]
+    
+    def append_lane(path, outfile):
+        md5 = hashlib.md5() if md5sums is not None else None
+        counter = lane_counter(count)
+        start_size = os.fstat(outfile.fileno()).st_size
+        compress = Timer()
+        total = Timer()
+        sizes = {"compressed": 0, "decompressed": 0}
+        if compressors[0] is None:
+            compressors[0] = open_compressor(
+                outfile if digest is None else HashingWriter(outfile, digest),
+                compression, stream[0])
+        compressor = compressors[0]
+        
+        def write(data):
+            sizes["decompressed"] += len(data)
+            if counter is not None:
+                counter.count(data)
+            with compress:
+                compressor.write(data)
+        
+        try:
+            with total:
+                try:
+                    with open(path, "rb") as infile:
+                        decompress_into(infile, write,
+                                        compression["buffer_size"], md5)
+                        sizes["compressed"] = infile.tell()
+                except Exception:
+                    compressors[0] = None
+                    compressor.abort()
+                    raise
+                if not external:
+                    compressors[0] = None
+                    with compress:
+                        compressor.close()
+                    stream[0] = compressor.state
+        finally:
+            METRICS.add("decompress", run, name,
+                        total.seconds - compress.seconds,
+                        total.cpu_seconds - compress.cpu_seconds,
+                        sizes["compressed"], sizes["decompressed"])
+            METRICS.add("compress", run, name, compress.seconds,
+                        compress.cpu_seconds, sizes["decompressed"],
+                        os.fstat(outfile.fileno()).st_size - start_size)
+        if md5 is not None:
+            check_digest(os.path.basename(path), md5, md5sums)
+        return counter
+    
+    def finish(outfile):
+        if compressors[0] is not None:
+            start_size = os.fstat(outfile.fileno()).st_size
+            compress = Timer()
+            try:
+                with compress:
+                    compressors[0].close()
+            finally:
+                compressors[0] = None
+                METRICS.add("compress", run, name, compress.seconds,
+                            compress.cpu_seconds, 0,
+                            os.fstat(outfile.fileno()).st_size - start_size)
+        finish_output(outfile, compression, stream[0])
+    
+    try:
+        merge_lanes(infolder, samples, out_path, append_lane, finish,
+                    checkpoint, final, digest, stream, not external)
+    except Exception:
+        if compressors[0] is not None:
+            compressors[0].abort()
+        raise
+
+def merged_file_name(samples, ss_info):
+    """
+    Return the name of the fastq file that samples are merged into, in the
+    form <experiment>_<sample name>_<read>.fastq. The sample name is taken
+    from ss_info ({S number: sample name}, see parse_sample_sheet), or from
+    the file name if the sample sheet does not have it, or else is the S
+    number, so that every sample gets a name of its own. Undetermined reads
+    are merged into Undetermined_<read>.fastq.
+    """
+    parsed = parse_fastq_name(samples[0])
+    if parsed.number == 0:
+        return "Undetermined_{}.fastq".format(parsed.read)
+    sample_name = (ss_info.get(parsed.number) or parsed.sample or 
+                   "S{}".format(parsed.number))
+    return "{}_{}_{}.fastq".format(parsed.project, sample_name, parsed.read)
+
+def merge_files(currentDir, samples, email_address, in_folder,
+                out_folder, ss_info, merge_mode="concat", md5sums=None,
+                compression=None, checkpoint=None, merged_name=None,
+                final=True, count=False, output_md5=False, single_lane=None):
     """
     Merges the files that are passed in to the function. If the output file 
     already exists, and the script is in this function, then the  output file 
     is likely to be the result of a failed run of the script and can be safely 
-    removed.
+    removed, unless checkpoint shows that it was finished. With merge_mode
+    "concat" the gzipped files are joined as they are, with "recompress"
+    they are decompressed and compressed again as one stream. If md5sums is
+    given, the files are checked against it as they are read for merging,
+    and the merged file is only kept if they all match. compression holds
+    the settings of the compression backend used when recompressing (see
+    compression.compression_settings). checkpoint lets an interrupted merge
+    be resumed (see merge_lanes). merged_name is worked out from samples and
+    ss_info when it is not given. If final is False, samples are only the
+    lane files that have arrived so far; they are appended to the partial
+    output, which is left unfinished, and None is returned. count and
+    output_md5 turn on the counting of records and bases and the md5 sum of
+    the merged file (see merge_lanes). The input files are never deleted
+    here; that is left to the caller, once the merged file has been checked
+    (see PostMerge).
+    
+    single_lane is None, or the methods that place_file tries in turn. A
+    merged file made from a single input file is then not written at all:
+    the input is cloned or hard linked to the output instead, and only
+    copied where neither is possible. md5sums and output_md5 then read the
+    input file once to hash it; with count the input is always copied.
     """
     logging.info("Merging files in {}".format(in_folder))
-    if not os.path.isdir(os.path.join(currentDir, out_folder)):
+    try:
         os.mkdir(os.path.join(currentDir, out_folder))
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
     
-    exp_name = re.search("(.+?)_", samples[0])
-    exp_sample = re.search("_S(\d+)_", samples[0])
-    exp_read = re.search("_(R\d+)_", samples[0])
-    merged_name = (exp_name.group(1) + "_" + ss_info[int(exp_sample.group(1))-1] +
-                   "_" + exp_read.group(1) + ".fastq")
+    if merged_name is None:
+        merged_name = merged_file_name(samples, ss_info)
         
     infolder = os.path.join(currentDir,in_folder)
     outfolder = os.path.join(currentDir, out_folder)
+    out_path = os.path.join(outfolder, merged_name + ".gz")
     
     logging.info("Writing output to {}.".format(os.path.join(outfolder,
                                                              merged_name)))
     
-    fastq_exists = check(outfolder, merged_name)
-    gz_exists = check(outfolder, merged_name + ".gz")
+    fastq_exists = file_size(os.path.join(outfolder, merged_name)) is not None
+    gz_size = file_size(out_path)
+    gz_exists = gz_size is not None
     
+    # A job that stopped after its output was renamed into place, but before
+    # it was released, is claimed again as Running; whether its output is
+    # complete is told by the checkpoint alone.
+    if (final and gz_exists and checkpoint is not None and 
+            checkpoint.lanes == samples and gz_size == checkpoint.offset):
+        logging.info("{} was already merged.".format(out_path))
+        checkpoint.save_output(lane_totals(checkpoint.counts), 
+                               hash_file(out_path) if output_md5 else None)
+        return out_path
     if fastq_exists:
         subject = ("File {} exists, but an error previously stopped the "
                    "script".format(merged_name))
@@ -188,70 +963,480 @@ def merge_files(currentDir, samples, keep_samples, email_address, in_folder,
         " it again. {} will be removed before continuing."
         .format(merged_name,merged_name))
         logging.warning(message)
-        send_mail(subject, message, email_address)
-        subprocess.Popen(["rm", "-f", merged_name], cwd=outfolder)
-    elif gz_exists:
+        send_mail(subject, message, email_address, currentDir)
+        os.remove(os.path.join(outfolder, merged_name))
+    if gz_exists:
         subject = ("File {}.gz exists, but an error previously stopped the "
                    "script".format(merged_name))
         message = ("The file {}.gz exists, but the script is trying to make"
         " it again. {}.gz will be removed before continuing."
         .format(merged_name,merged_name))
         logging.warning(message)
-        send_mail(subject, message, email_address)
-        subprocess.Popen(["rm", "-f", merged_name + ".gz"], cwd=outfolder)
+        send_mail(subject, message, email_address, currentDir)
+        os.remove(out_path)
+    
+    logging.info("Beginning merging on {} at {}.".format(samples,
+                            strftime("%H:%M:%S, %A, %B %d, %Y", gmtime())))
+    if (single_lane is not None and final and len(samples) == 1 and 
+            not count and (checkpoint is None or not checkpoint.lanes) and
+            place_single_file(infolder, samples[0], out_path, md5sums,
+                              checkpoint, output_md5, single_lane)):
+        return out_path
+    if merge_mode == "concat":
+        concat_files(infolder, samples, out_path, md5sums, checkpoint, final,
+                     count, output_md5)
     else:
-        logging.info("Beginning merging on {} at {}.".format(samples,
-                                strftime("%H:%M:%S, %A, %B %d, %Y", gmtime())))
-        for sample in samples:
-            logging.info("Merging sample {}...".format(sample))
-            with open(os.path.join(outfolder, merged_name), "a+") as outfile:
-                decompress = subprocess.Popen(["/usr/bin/gzip", "-dc", sample],
-                                 stdout=outfile, cwd=infolder)
-                decompress.wait()
-                logging.info("Merging for sample {} finished at {}.".format(
-                        sample,strftime("%H:%M:%S, %A, %B %d, %Y", gmtime())))
-        logging.info("Starting compression on {} at {}.".format(merged_name,
-                                strftime("%H:%M:%S, %A, %B %d, %Y", gmtime())))
-        compress = subprocess.Popen(["gzip", merged_name], cwd=outfolder)
-        compress.wait()
-        logging.info("Finished compression on {} at {}.".format(merged_name,
-                                strftime("%H:%M:%S, %A, %B %d, %Y", gmtime())))
-        delete_samples(infolder, samples, keep_samples)
-
-def delete_samples(currentDir, samples, keep_samples):
-    if not keep_samples:
-        [subprocess.Popen(["rm", "-f", sample], cwd=currentDir) for sample
-         in samples]
-        
+        if compression is None:
+            compression = compression_settings({})
+        recompress_files(infolder, samples, out_path, compression, md5sums,
+                         checkpoint, final, count, output_md5)
+    if not final:
+        return None
+    return out_path
+
+def place_single_file(infolder, sample, out_path, md5sums=None,
+                      checkpoint=None, output_md5=False,
+                      methods=("reflink", "hardlink")):
+    """
+    Make out_path from the single file sample in infolder with place_file,
+    after checking it against md5sums and hashing it for output_md5, if
+    either is given. The result is recorded in checkpoint like that of
+    merge_lanes. Returns False, without changing anything, if the file could
+    not be placed and has to be copied instead.
+    """
+    run, name = metrics_key(infolder, out_path)
+    path = os.path.join(infolder, sample)
+    digest = None
+    if md5sums is not None or output_md5:
+        with measure("verify", run, name) as stage:
+            digest = hash_file(path)
+            stage.bytes_read = os.path.getsize(path)
+        if md5sums is not None and md5sums.get(sample) != digest:
+            raise IOError("The md5 sum of {} does not match md5sums.txt. The "
+                          "file is still copying or was corrupted."
+                          .format(sample))
+    with measure("link", run, name):
+        method = place_file(path, out_path, methods)
+    if method is None:
+        return False
+    logging.info("{} was made from {} by {}.".format(out_path, sample, method))
+    try:
+        os.remove(out_path + ".part")
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            raise
+    if checkpoint is not None:
+        checkpoint.save([sample], os.path.getsize(out_path))
+        checkpoint.save_output(None, digest if output_md5 else None)
+    return True
+
+def delete_samples(currentDir, samples):
+    """
+    Delete the files in samples, which are relative to currentDir. Files that
+    are already gone are skipped.
+    """
+    for sample in samples:
+        try:
+            os.unlink(os.path.join(currentDir, sample))
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+
+def build_merge_jobs(run, sample_groups, ss_info, md5sums=None):
+    """
+    Turn the lane files of run, grouped as {sample: {read: [LaneFiles]}}
+    (see run_index.group_files), into a list of independent merge jobs, one
+    for every read of every sample. Every job holds the names of its files
+    and their sizes, None for a file that is not there yet. md5sums is
+    passed on to merge_files when the md5 sums are checked while merging.
+    Raises a ValueError if two jobs would be merged into the same file, as
+    the job table keeps one job per merged file.
+    """
+    jobs = []
+    names = {}
+    for sample in sorted(sample_groups):
+        for read in sorted(sample_groups[sample]):
+            lanes = sample_groups[sample][read]
+            if not lanes:
+                continue
+            item = [lane.name for lane in lanes]
+            name = merged_file_name(item, ss_info)
+            if name in names:
+                raise ValueError("{} and {} in {} would both be merged into "
+                                 "{}.".format(names[name], item[0], run, name))
+            names[name] = item[0]
+            jobs.append({"run": run, "samples": item, "ss_info": ss_info,
+                         "name": name, "md5sums": md5sums,
+                         "sizes": [lane.size for lane in lanes]})
+    return jobs
+
+def reject_run(config_, conn, run, message):
+    """
+    Mark run as Failed without merging any of it, and tell the admin why.
+    """
+    logging.error(message)
+    send_mail("Run failed merging.", message, config_["email"]["admin"], run)
+    set_run_status(conn, config_["database"]["table_name"], run, "Failed")
+
+def single_lane_methods(config_):
+    """
+    Return the methods merge_files tries to make a merged file from a single
+    input file without copying it (see place_file), or None if such files
+    are merged like any other. link_single_lane is on by default in concat
+    mode, where the merged file would be a copy of the input anyway. When
+    the input files are not kept a hard link is tried first, as the input
+    file is deleted afterwards and the merged file keeps its blocks.
+    """
+    runs = config_["runs"]
+    merge_mode = runs.get("merge_mode", "concat")
+    if (not runs.get("link_single_lane", merge_mode == "concat") or 
+            runs.get("count_records")):
+        return None
+    if runs["keep_original_files"]:
+        return ("reflink", "hardlink")
+    return ("hardlink", "reflink")
+
+def merge_estimate(config_, sizes, single=False):
+    """
+    Return the estimated size of the output of a merge of input files with
+    the given sizes (see admission.estimate_output). A single input file
+    that is the whole of a merged file (single) costs nothing when it is
+    linked into place (see single_lane_methods).
+    """
+    if single and single_lane_methods(config_) is not None:
+        return 0
+    return estimate_output(sizes, config_["runs"].get("merge_mode", "concat"),
+                           (config_.get("scheduler") or {}).get(
+                               "recompress_ratio", 1.1))
+
+def run_merge_job(job, config_, io_slots, conn=None):
+    """
+    Run a single merge job, holding an I/O slot for the filesystem the run
+    lives on while merging. Returns a result record for the job instead of
+    raising, so that one failed merge does not stop the others. If conn is
+    given, the progress of the merge is checkpointed in the run database.
+    """
+    result = {"run": job["run"], "name": job["name"], "ok": False,
+              "error": None, "output": None}
+    start = time()
+    try:
+        with io_slots[os.stat(job["run"]).st_dev]:
+            checkpoint = None
+            if conn is not None:
+                checkpoint = JobCheckpoint(conn, 
+                                           config_["database"]["table_name"],
+                                           job["run"], job["name"])
+            result["output"] = merge_files(job["run"], job["samples"],
+                                           config_["email"]["admin"],
+                                           config_["runs"]["in_folder"],
+                                           config_["runs"]["out_folder"],
+                                           job["ss_info"],
+                                           config_["runs"].get("merge_mode",
+                                                               "concat"),
+                                           job.get("md5sums"),
+                                           config_.get("compression_settings"),
+                                           checkpoint, job["name"],
+                                           job.get("final", True),
+                                           config_["runs"].get("count_records",
+                                                               False),
+                                           config_["runs"].get("output_md5",
+                                                               False),
+                                           single_lane_methods(config_))
+        result["ok"] = True
+    except (ValueError, OSError, IOError, CalledProcessError) as e:
+        logging.error("Merging {} in {} failed.".format(job["name"], job["run"]),
+                      exc_info = True)
+        result["error"] = str(e)
+    result["seconds"] = time() - start
+    return result
+
+class IOSlots(dict):
+    """
+    One semaphore per filesystem, created the first time a run on that
+    filesystem is looked up, that lets at most max_io_jobs merges work on the
+    filesystem at the same time.
+    """
+
+    def __init__(self, max_io_jobs):
+        dict.__init__(self)
+        self.max_io_jobs = max_io_jobs
+        self.lock = threading.Lock()
+
+    def __missing__(self, device):
+        with self.lock:
+            return self.setdefault(device, 
+                                   threading.BoundedSemaphore(self.max_io_jobs))
+
+def log_result(result):
+    if result["ok"]:
+        logging.info("Merged {} in {} in {:.1f} seconds.".format(
+            result["name"], result["run"], result["seconds"]))
+
+def work_queue(config_, conn, post, select=None):
+    """
+    Claim and run merge jobs from the job table of the run database on
+    max_workers threads until no queued job is left. At most max_io_jobs
+    merges run at the same time on any one filesystem, so that a single disk
+    is not thrashed by many parallel writers. Jobs may belong to runs queued
+    by other processes or nodes. Failed jobs are queued again until they have
+    been tried max_attempts times, and jobs abandoned by a process that
+    stopped are picked up again. Unless keep_original_files is set, the input
+    files of every finished job are handed to post (see PostMerge) to be
+    deleted. Returns a result record for every job run by this process.
+    
+    A job is only started if its estimated output fits on the disk of its
+    run (see admission.py). Jobs that do not fit wait until running jobs
+    finish or deleted input files free enough space, and are left queued for
+    the next pass if neither is going to happen. Unless keep_original_files
+    is set, the largest job that fits is started first, so that deleting its
+    input files frees the most space for the jobs after it.
+    
+    If select is given, only the jobs for which select(run, samples) is True
+    are run (see job_filter); the others are left queued.
+    """
+    table_name = config_["database"]["table_name"]
+    scheduler = config_.get("scheduler") or {}
+    max_workers = scheduler.get("max_workers", 1)
+    max_attempts = scheduler.get("max_attempts", 3)
+    stale_seconds = scheduler.get("stale_seconds", 300)
+    io_slots = IOSlots(scheduler.get("max_io_jobs", max_workers))
+    budget = DiskBudget(scheduler.get("space_margin_percent", 5))
+    keep_inputs = config_["runs"]["keep_original_files"]
+    in_folder = config_["runs"]["in_folder"]
+    estimates = {}
+    warned = set()
+    warned_lock = threading.Lock()
+    md5sums = {}
+    md5_lock = threading.Lock()
+    
+    def job_estimate(row):
+        job_id, run, name, samples, lanes_done, final, lane_sizes = row
+        if (job_id, samples) not in estimates:
+            done = set(lanes_done.split("\n")) if lanes_done else set()
+            names = samples.split("\n") if samples else []
+            known = lane_sizes.split("\n") if lane_sizes else []
+            sizes = []
+            for index, sample in enumerate(names):
+                if sample in done:
+                    continue
+                if index < len(known) and known[index]:
+                    sizes.append(int(known[index]))
+                    continue
+                # Jobs queued before the sizes were kept in the job table.
+                try:
+                    sizes.append(os.path.getsize(os.path.join(run, in_folder,
+                                                              sample)))
+                except OSError:
+                    pass
+            estimates[(job_id, samples)] = merge_estimate(
+                config_, sizes, final and not done and samples and 
+                "\n" not in samples)
+        return estimates[(job_id, samples)]
+    
+    def admit_job():
+        """
+        Claim the next queued job that fits on its disk. Returns the job and
+        its reservation, and the rows of the jobs that did not fit.
+        """
+        rows = [row for row in queued_jobs(conn, table_name) 
+                if select is None or 
+                select(row[1], row[3].split("\n") if row[3] else [])]
+        if not keep_inputs:
+            rows.sort(key=lambda row: -job_estimate(row))
+        too_big = []
+        for row in rows:
+            out_dir = os.path.join(row[1], config_["runs"]["out_folder"])
+            try:
+                reservation = budget.admit(out_dir if os.path.isdir(out_dir)
+                                           else row[1], job_estimate(row))
+            except OSError:
+                reservation = None
+            if reservation is None:
+                too_big.append(row)
+                continue
+            job = claim_job(conn, table_name, row[0])
+            if job is not None:
+                return job, reservation, too_big
+            budget.release(reservation)
+        return None, None, too_big
+    
+    def report_waiting(rows):
+        for row in rows:
+            run, name = row[1], row[2]
+            with warned_lock:
+                if run in warned:
+                    continue
+                warned.add(run)
+            try:
+                available = budget.available(run)
+            except OSError:
+                available = 0
+            message = ("There is not enough free space on the disk of {} to "
+                       "merge {}, which needs about {:.1f} GB while {:.1f} GB "
+                       "are available. It will be merged once there is space."
+                       .format(run, name, job_estimate(row) / 1e9,
+                               available / 1e9))
+            logging.warning(message)
+            send_mail("Not enough disk space to merge", message,
+                      config_["email"]["admin"], run)
+    
+    def job_md5sums(run):
+        if not (config_["verify_transfer"]["use_md5"] and
+                config_["verify_transfer"].get("verify_during_merge")):
+            return None
+        with md5_lock:
+            if run not in md5sums:
+                md5sums[run] = read_md5sums(os.path.join(
+                    run, config_["runs"]["in_folder"]))
+            return md5sums[run]
+    
+    def run_job(job):
+        try:
+            job["md5sums"] = job_md5sums(job["run"])
+        except IOError as e:
+            result = {"run": job["run"], "name": job["name"], "ok": False,
+                      "error": str(e), "output": None, "seconds": 0}
+        else:
+            result = run_merge_job(job, config_, io_slots, conn)
+        status = release_job(conn, table_name, job, result["error"],
+                             max_attempts)
+        if status == "Queued":
+            logging.warning("Merging {} in {} will be tried again."
+                            .format(job["name"], job["run"]))
+        elif status == "Done" and result["output"] and not keep_inputs:
+            post.delete(job["run"], job["name"], result["output"], 
+                        [os.path.join(in_folder, sample)
+                         for sample in job["samples"]])
+        log_result(result)
+        return result
+    
+    def worker(index):
+        results = []
+        while True:
+            # Whether space may still be freed is looked at both before and
+            # after the jobs are, so that neither space freed nor a job
+            # started in between is missed.
+            freeing = budget.busy() or post.deleting()
+            job, reservation, too_big = admit_job()
+            if job is None and reset_stale_jobs(conn, table_name, 
+                                                stale_seconds, max_attempts):
+                continue
+            if job is None and too_big and (freeing or budget.busy() or
+                                            post.deleting()):
+                budget.wait(5)
+                continue
+            if job is None:
+                report_waiting(too_big)
+                return results
+            # The space is only given back once the deletion of the input
+            # files has been queued, so that no worker gives up on a job
+            # that will fit once they are gone.
+            try:
+                results.append(run_job(job))
+            finally:
+                budget.release(reservation)
+    
+    logging.info("Working on queued merge jobs on {} workers."
+                 .format(max_workers))
+    pool = thread_pool(max_workers)
+    try:
+        results = [result for worker_results in 
+                   pool.map(worker, range(max_workers))
+                   for result in worker_results]
+    finally:
+        pool.close()
+        pool.join()
+    return results
+
+def read_sample_sheet(path):
+    """
+    Read a SampleSheet.csv into its sections, as {section name: [rows]},
+    where every row is a list of fields. Rows before the first section are
+    put in the "Header" section.
+    """
+    sections = {}
+    rows = sections.setdefault("Header", [])
+    with open(path, "r") as sample_sheet:
+        for line_number, row in enumerate(csv.reader(sample_sheet)):
+            if line_number == 0 and row:
+                row[0] = row[0].replace(u"\ufeff", "")
+            row = [field.strip() for field in row]
+            if not any(row):
+                continue
+            if row[0].startswith("[") and row[0].endswith("]"):
+                rows = sections.setdefault(row[0][1:-1], [])
+                continue
+            rows.append(row)
+    return sections
+
+def sample_sheet_samples(sections):
+    """
+    Return the samples in the [Data] section of a sample sheet as
+    ({S number: "<Sample_ID>_<Sample_Name>"}, {S number: set of lanes}).
+    bcl2fastq numbers the samples in the order they first appear in the
+    sheet, so a sample that is on several lanes keeps the same number. The
+    lanes come from the Lane column, and are left out if the sheet has none.
+    """
+    data = sections.get("Data") or []
+    if not data or "Sample_ID" not in data[0]:
+        return {}, {}
+    columns = data[0]
+    sample_id = columns.index("Sample_ID")
+    sample_name = (columns.index("Sample_Name") if "Sample_Name" in columns 
+                   else None)
+    lane = columns.index("Lane") if "Lane" in columns else None
+    samples = {}
+    lanes = {}
+    numbers = {}
+    for row in data[1:]:
+        if len(row) <= sample_id or not row[sample_id]:
+            continue
+        if row[sample_id] not in numbers:
+            numbers[row[sample_id]] = len(numbers) + 1
+            name = row[sample_id]
+            if (sample_name is not None and len(row) > sample_name and 
+                    row[sample_name]):
+                name += "_" + row[sample_name]
+            samples[numbers[row[sample_id]]] = name
+        if lane is not None and len(row) > lane and row[lane].isdigit():
+            lanes.setdefault(numbers[row[sample_id]], set()).add(int(row[lane]))
+    return samples, lanes
+
 def parse_sample_sheet(currentDir,admin_email,use_ss_email):
     """
     Parse the sample sheet in the run directory to extract the sample names
     (to cover cases where the sample sheet has been incorrectly filled out and
     information is missing from the fastq file names). Additionally, the 
     investigator email can be obtained so that an email can be sent when the 
-    merging finishes.
+    merging finishes. Returns ({S number: sample name}, email, {S number:
+    set of lanes}) (see sample_sheet_samples). The parsed sheet is kept until
+    the file changes, so the daemon does not read it again on every pass.
     """
-    found_data = False
-    samples = []
-    email_ = admin_email
+    path = os.path.join(currentDir, "SampleSheet.csv")
     try:
-        with open(os.path.join(currentDir,"SampleSheet.csv"),"r") as sample_sheet:
-            for line in sample_sheet:
-                if use_ss_email:
-                    email_ = re.search("^Investigator Name,(.+)", line)
-                if not found_data:
-                    if re.search("[Data]", line):
-                        found_data = True
-                if found_data:
-                    if line.startswith("1"):
-                        samples.append(line.split(",")[1] + "_" +
-                                       line.split(",")[2])
-    except IOError:
+        with measure("sample_sheet", currentDir) as stage:
+            stat = os.stat(path)
+            cached = SAMPLE_SHEETS.get(path)
+            if (cached is not None and
+                    cached[0] == (stat.st_mtime, stat.st_size)):
+                sections = cached[1]
+            else:
+                sections = read_sample_sheet(path)
+                SAMPLE_SHEETS[path] = ((stat.st_mtime, stat.st_size), 
+                                       sections)
+                stage.bytes_read = stat.st_size
+    except (IOError, OSError, csv.Error):
         logging.error("The samplesheet does not exist in {}, or an error "
                       "occurred while trying to open it. Defaulting to admin "
                       "email {}.".format(currentDir,admin_email)) 
-    samples_and_email = (samples,email_)
-    return samples_and_email
+        return ({}, admin_email, {})
+    email_ = admin_email
+    if use_ss_email:
+        for row in sections.get("Header", []):
+            if len(row) > 1 and row[0] == "Investigator Name" and row[1]:
+                email_ = row[1]
+    samples, lanes = sample_sheet_samples(sections)
+    return (samples, email_, lanes)
 
 def default_logger(msg):
     """
@@ -272,54 +1457,809 @@ def get_current_pid():
     """
     return str(os.getpid())
 
-def get_running_pid(user):
-    """
-    Check all running PIDs to see what ones are running python
-    """
-    running_processes = subprocess.Popen(["ps", "-u", user],
-                                         stdout=subprocess.PIPE)
-    check_processes = subprocess.Popen(["grep", "\s[0-9]*\s"],
-                                       stdin=running_processes.stdout,
-                                       stdout=subprocess.PIPE)
-    python_processes = subprocess.Popen(["grep", "\s"+"python$"],
-                                        stdin=check_processes.stdout,
-                                        stdout=subprocess.PIPE)
-    running_processes.stdout.close()
-    check_processes.stdout.close()
-    out = python_processes.communicate()
-    pids = []
-    for process in out:
-        if process is not None:
-            pids.append(int(process.split(" ")[1]))
-    return pids
-    
-def connect_to_db(location_, name_):
-    connection = sqlite3.connect(os.path.join(location_,name_))
+def connect_to_db(location_, name_, shared=False):
+    """
+    Connect to the run database. The database is put in WAL mode so that it
+    can be read while a merge is writing to it, unless it is shared by
+    several hosts: WAL needs shared memory, so it only works with every
+    connection on one host, and a shared database uses a rollback journal
+    instead. The connection is shared with the merge threads, which write to
+    it while holding DB_LOCK.
+    """
+    connection = sqlite3.connect(os.path.join(location_,name_), timeout=60,
+                                 check_same_thread=False)
+    connection.execute("PRAGMA journal_mode={}"
+                       .format("DELETE" if shared else "WAL"))
     return connection
 
 def create_db_table(connection, table_name):
+    """
+    Create the run table, with one row per run, and the job table, with one
+    row per merged file of a run. Run tables made by older versions of the
+    script have no primary key, so duplicate rows are dropped from them and a
+    unique index is put on Run_ID instead. The tables are changed in one
+    write transaction, so that several processes starting at the same time
+    do not trip over each other.
+    """
     conn_cursor = connection.cursor()
-    conn_cursor.execute("CREATE TABLE IF NOT EXISTS {} (Run_ID text, "
-                       "Process_ID int, Status text, Email text, Name text)"
-                       .format(table_name))
+    conn_cursor.execute("BEGIN IMMEDIATE")
+    conn_cursor.execute("CREATE TABLE IF NOT EXISTS {} (Run_ID text PRIMARY "
+                        "KEY, Process_ID int, Status text, Email text, Name "
+                        "text, Updated real, Host text, Heartbeat real)"
+                        .format(table_name))
+    columns = [row[1] for row in conn_cursor.execute("PRAGMA table_info({})"
+                                                     .format(table_name))]
+    for column, column_type in (("Updated", "real"), ("Host", "text"),
+                                ("Heartbeat", "real")):
+        if column not in columns:
+            conn_cursor.execute("ALTER TABLE {} ADD COLUMN {} {}"
+                                .format(table_name, column, column_type))
+    if not conn_cursor.execute("SELECT name FROM sqlite_master WHERE type = "
+                               "'index' AND name = ?", 
+                               (table_name + "_run",)).fetchone():
+        conn_cursor.execute("DELETE FROM {0} WHERE rowid NOT IN (SELECT "
+                            "MAX(rowid) FROM {0} GROUP BY Run_ID)"
+                            .format(table_name))
+        conn_cursor.execute("CREATE UNIQUE INDEX {0}_run ON {0} (Run_ID)"
+                            .format(table_name))
+    conn_cursor.execute("CREATE INDEX IF NOT EXISTS {0}_status ON {0} "
+                        "(Status)".format(table_name))
+    conn_cursor.execute("CREATE TABLE IF NOT EXISTS {}_jobs (Job_ID integer "
+                        "PRIMARY KEY, Run_ID text, Name text, Status text, "
+                        "Process_ID int, Error text, Updated real, "
+                        "Lanes_Done text, Output_Size int, Samples text, "
+                        "Host text, Heartbeat real, Attempts int, Claim text, "
+                        "Final int, Lane_Counts text, Records int, Bases int, "
+                        "Output_MD5 text, Stream_State text, Lane_Sizes "
+                        "text, UNIQUE (Run_ID, Name))"
+                        .format(table_name))
+    columns = [row[1] for row in conn_cursor.execute("PRAGMA table_info({}_jobs)"
+                                                     .format(table_name))]
+    for column, column_type in (("Lanes_Done", "text"), 
+                                ("Output_Size", "int"), ("Samples", "text"),
+                                ("Host", "text"), ("Heartbeat", "real"),
+                                ("Attempts", "int"), ("Claim", "text"),
+                                ("Final", "int"), ("Lane_Counts", "text"),
+                                ("Records", "int"), ("Bases", "int"),
+                                ("Output_MD5", "text"), 
+                                ("Stream_State", "text"), 
+                                ("Lane_Sizes", "text")):
+        if column not in columns:
+            conn_cursor.execute("ALTER TABLE {}_jobs ADD COLUMN {} {}"
+                                .format(table_name, column, column_type))
+    conn_cursor.execute("CREATE INDEX IF NOT EXISTS {0}_jobs_status ON "
+                        "{0}_jobs (Run_ID, Status)".format(table_name))
+    conn_cursor.execute("CREATE INDEX IF NOT EXISTS {0}_jobs_claim ON "
+                        "{0}_jobs (Claim)".format(table_name))
     connection.commit()
 
 def check_db_table(connection, table_name):
-    tb_exists = ("SELECT name FROM sqlite_master WHERE type='table' AND "
-                 "name='{}'".format(table_name))
-    if not connection.execute(tb_exists).fetchone():
-        create_db_table(connection,table_name)
-        
-def select_from_db(connection, table_name, column_name, selection, select_type):
+    """
+    Make sure that all the tables of the run database exist and are up to
+    date.
+    """
+    with DB_LOCK:
+        create_db_table(connection, table_name)
+        create_md5_cache_table(connection, table_name)
+        create_metrics_table(connection, table_name)
+        create_post_table(connection, table_name)
+
+def set_run_status(connection, table_name, run_id, status, email=None):
+    """
+    Record the status of run_id, and the process working on it.
+    """
+    with DB_LOCK:
+        connection.execute("INSERT OR IGNORE INTO {} (Run_ID, Name) VALUES "
+                           "(?, ?)".format(table_name), 
+                           (run_id, os.path.basename(run_id)))
+        connection.execute("UPDATE {} SET Status = ?, Process_ID = ?, Email = "
+                           "COALESCE(?, Email), Updated = ?, Host = ?, "
+                           "Heartbeat = ? WHERE Run_ID = ?".format(table_name), 
+                           (status, os.getpid(), email, time(), node_name(),
+                            time(), run_id))
+        connection.commit()
+
+def beat_runs(connection, table_name, run_ids):
+    """
+    Update the heartbeat of the runs in run_ids, and of every job, that this
+    process works on.
+    """
+    with DB_LOCK:
+        connection.executemany("UPDATE {} SET Heartbeat = ? WHERE Run_ID = ? "
+                               "AND Process_ID = ? AND Host = ?"
+                               .format(table_name), 
+                               [(time(), run_id, os.getpid(), node_name())
+                                for run_id in run_ids])
+        connection.execute("UPDATE {}_jobs SET Heartbeat = ? WHERE Status = "
+                           "'Running' AND Process_ID = ? AND Host = ?"
+                           .format(table_name), 
+                           (time(), os.getpid(), node_name()))
+        connection.commit()
+
+def run_is_live(row, stale_seconds):
+    """
+    Return True if the run in row, with the columns Process_ID, Host and
+    Heartbeat, is being worked on by a process that is still running.
+    """
+    pid, host, heartbeat = row
+    if heartbeat is None or time() - heartbeat > stale_seconds:
+        return False
+    if host == node_name():
+        return process_alive(pid)
+    return True
+
+def run_owned_elsewhere(connection, table_name, run_id, stale_seconds):
+    """
+    Return True if another live process is verifying run_id.
+    """
+    with DB_LOCK:
+        row = connection.execute("SELECT Process_ID, Host, Heartbeat FROM {} "
+                                 "WHERE Run_ID = ? AND Status = 'Verifying'"
+                                 .format(table_name), (run_id,)).fetchone()
+    if row is None or (row[0] == os.getpid() and row[1] == node_name()):
+        return False
+    return run_is_live(row, stale_seconds)
+
+def reset_stale_runs(connection, table_name, stale_seconds):
+    """
+    Find the runs that are marked as being verified by a process that has
+    stopped, either because its heartbeat is older than stale_seconds or
+    because it no longer exists on this host. These runs are set back to
+    Waiting so that they are picked up again. Returns the stale runs.
+    """
+    with DB_LOCK:
+        rows = connection.execute("SELECT Run_ID, Process_ID, Host, Heartbeat "
+                                  "FROM {} WHERE Status = 'Verifying'"
+                                  .format(table_name)).fetchall()
+    stale = [row[0] for row in rows if not (row[1] == os.getpid() and
+                                            row[2] == node_name()) and
+             not run_is_live(row[1:], stale_seconds)]
+    if not stale:
+        return stale
+    with DB_LOCK:
+        connection.executemany("UPDATE {} SET Status = 'Waiting', Updated = ? "
+                               "WHERE Run_ID = ? AND Status = 'Verifying'"
+                               .format(table_name), 
+                               [(time(), run_id) for run_id in stale])
+        connection.commit()
+    logging.warning("The processes verifying {} have stopped, the runs will "
+                    "be verified again.".format(stale))
+    return stale
+
+def reset_stale_jobs(connection, table_name, stale_seconds, max_attempts):
+    """
+    Find the merge jobs that are marked as Running by a process that has
+    stopped (see reset_stale_runs). They are queued again, or marked as
+    Failed if they have already been tried max_attempts times. Returns the
+    stale jobs as (Run_ID, Name) pairs.
+    """
+    with DB_LOCK:
+        rows = connection.execute("SELECT Job_ID, Run_ID, Name, Process_ID, "
+                                  "Host, Heartbeat FROM {}_jobs WHERE Status "
+                                  "= 'Running'".format(table_name)).fetchall()
+    stale = [row for row in rows if not (row[3] == os.getpid() and
+                                         row[4] == node_name()) and
+             not run_is_live(row[3:], stale_seconds)]
+    if not stale:
+        return []
+    with DB_LOCK:
+        connection.executemany("UPDATE {}_jobs SET Status = CASE WHEN "
+                               "COALESCE(Attempts, 0) < ? THEN 'Queued' ELSE "
+                               "'Failed' END, Error = 'The process merging "
+                               "this file stopped.', Claim = NULL, Updated = ? "
+                               "WHERE Job_ID = ? AND Status = 'Running'"
+                               .format(table_name), 
+                               [(max_attempts, time(), row[0]) 
+                                for row in stale])
+        connection.commit()
+    logging.warning("The processes merging {} have stopped, the files will be "
+                    "merged again.".format([row[2] for row in stale]))
+    return [(row[1], row[2]) for row in stale]
+
+def queue_jobs(connection, table_name, jobs):
+    """
+    Put the merge jobs in the job table, where any node can claim them (see
+    claim_job). Jobs that are already done, or are running, are left alone.
+    Jobs that are not final (see plan_incremental_run) and have no files
+    that are ready are recorded as Partial, and so are Partial jobs whose
+    files have not changed since they were last merged. The sizes of the
+    files, where the job has them, are kept for the scheduler (see
+    work_queue).
+    """
+    with DB_LOCK:
+        for job in jobs:
+            samples = "\n".join(job["samples"])
+            sizes = "\n".join("" if size is None else str(size)
+                              for size in job.get("sizes") or [])
+            connection.execute("INSERT OR IGNORE INTO {}_jobs (Run_ID, Name) "
+                               "VALUES (?, ?)".format(table_name), 
+                               (job["run"], job["name"]))
+            connection.execute("UPDATE {}_jobs SET Samples = ?, Lane_Sizes "
+                               "= ?, Status = ?, Final = ?, Attempts = 0, "
+                               "Error = NULL, Claim = NULL, Updated = ? WHERE "
+                               "Run_ID = ? AND Name = ? AND COALESCE(Status, "
+                               "'') NOT IN ('Done', 'Running') AND NOT "
+                               "(COALESCE(Status, '') = 'Partial' AND "
+                               "COALESCE(Samples, '') = ? AND COALESCE(Final, "
+                               "1) = 0 AND ? = 0)"
+                               .format(table_name),
+                               (samples, sizes or None, 
+                                "Queued" if job["samples"] else
+                                "Partial", int(job.get("final", True)), time(),
+                                job["run"], job["name"], samples, 
+                                int(job.get("final", True))))
+        connection.commit()
+
+def queued_jobs(connection, table_name):
+    """
+    Return the queued jobs of the runs that are being merged, oldest first,
+    as (Job_ID, Run_ID, Name, Samples, Lanes_Done, Final, Lane_Sizes) rows.
+    """
+    with DB_LOCK:
+        return connection.execute("SELECT {0}_jobs.Job_ID, {0}_jobs.Run_ID, "
+                                  "{0}_jobs.Name, {0}_jobs.Samples, "
+                                  "{0}_jobs.Lanes_Done, COALESCE({0}_jobs."
+                                  "Final, 1), {0}_jobs.Lane_Sizes FROM "
+                                  "{0}_jobs JOIN {0} "
+                                  "ON {0}.Run_ID = {0}_jobs.Run_ID WHERE "
+                                  "{0}.Status = 'Merging' AND {0}_jobs.Status "
+                                  "= 'Queued' ORDER BY {0}_jobs.Job_ID"
+                                  .format(table_name)).fetchall()
+
+def claim_job(connection, table_name, job_id=None):
+    """
+    Claim the queued job job_id, or if it is None the oldest queued job, of
+    a run that is being merged, and return it as a job record (see
+    build_merge_jobs) with its Job_ID under "id", or None if there is nothing
+    to do or the job was claimed by someone else first. The claim is a
+    single UPDATE, so two processes, on one host or on several hosts sharing
+    the database, can never claim the same job.
+    """
+    claim = uuid.uuid4().hex
+    with DB_LOCK:
+        connection.execute("UPDATE {0}_jobs SET Status = 'Running', Claim = ?, "
+                           "Process_ID = ?, Host = ?, Heartbeat = ?, Updated = "
+                           "?, Attempts = COALESCE(Attempts, 0) + 1 WHERE "
+                           "Job_ID = (SELECT {0}_jobs.Job_ID FROM {0}_jobs "
+                           "JOIN {0} ON {0}.Run_ID = {0}_jobs.Run_ID WHERE "
+                           "{0}.Status = 'Merging' AND {0}_jobs.Status = "
+                           "'Queued' AND {0}_jobs.Job_ID = COALESCE(?, "
+                           "{0}_jobs.Job_ID) ORDER BY {0}_jobs.Job_ID LIMIT 1)"
+                           .format(table_name), 
+                           (claim, os.getpid(), node_name(), time(), time(),
+                            job_id))
+        connection.commit()
+        row = connection.execute("SELECT Job_ID, Run_ID, Name, Samples, Final "
+                                 "FROM {}_jobs WHERE Claim = ?"
+                                 .format(table_name), (claim,)).fetchone()
+    if row is None:
+        return None
+    return {"id": row[0], "run": row[1], "name": row[2], 
+            "samples": row[3].split("\n") if row[3] else [], "ss_info": None,
+            "final": row[4] != 0}
+
+def release_job(connection, table_name, job, error, max_attempts):
+    """
+    Record the outcome of a claimed job. A job that failed is queued again
+    until it has been tried max_attempts times, and is then marked as Failed.
+    A job that is not final is marked as Partial when it succeeds. Returns
+    the new status of the job.
+    """
+    with DB_LOCK:
+        if error is None:
+            connection.execute("UPDATE {}_jobs SET Status = ?, Error = NULL, "
+                               "Claim = NULL, Updated = ? WHERE Job_ID = ?"
+                               .format(table_name), 
+                               ("Done" if job.get("final", True) else 
+                                "Partial", time(), job["id"]))
+        else:
+            connection.execute("UPDATE {}_jobs SET Status = CASE WHEN "
+                               "COALESCE(Attempts, 0) < ? THEN 'Queued' ELSE "
+                               "'Failed' END, Error = ?, Claim = NULL, "
+                               "Updated = ? WHERE Job_ID = ?"
+                               .format(table_name), 
+                               (max_attempts, error, time(), job["id"]))
+        connection.commit()
+        return connection.execute("SELECT Status FROM {}_jobs WHERE Job_ID = "
+                                  "?".format(table_name), 
+                                  (job["id"],)).fetchone()[0]
+
+def finish_run(connection, table_name, run_id, status):
+    """
+    Move run_id from Merging to status, unless another process got there
+    first. Returns True if this process did it, and so should send the email
+    about it.
+    """
+    with DB_LOCK:
+        cursor = connection.execute("UPDATE {} SET Status = ?, Process_ID = ?, "
+                                    "Host = ?, Updated = ? WHERE Run_ID = ? "
+                                    "AND Status = 'Merging'".format(table_name),
+                                    (status, os.getpid(), node_name(), time(),
+                                     run_id))
+        connection.commit()
+        return cursor.rowcount == 1
+
+class JobCheckpoint(object):
+    """
+    The progress of a merge job, kept in the job table of the run database:
+    the lane files that have been appended to the output so far, the size of
+    the output after the last of them, and the records and bases counted in
+    each of them (None for files that were not counted).
+    """
+
+    def __init__(self, connection, table_name, run_id, name):
+        self.connection = connection
+        self.table_name = table_name
+        self.run_id = run_id
+        self.name = name
+        with DB_LOCK:
+            row = connection.execute("SELECT Lanes_Done, Output_Size, "
+                                     "Lane_Counts, Stream_State FROM {}_jobs "
+                                     "WHERE Run_ID = ? AND Name = ?"
+                                     .format(table_name), 
+                                     (run_id, name)).fetchone()
+        self.lanes = row[0].split("\n") if row and row[0] else []
+        self.offset = row[1] or 0 if row else 0
+        self.counts = [None] * len(self.lanes)
+        if row and row[2]:
+            self.counts = [tuple(int(value) for value in line.split())
+                           if line else None for line in row[2].split("\n")]
+        self.stream_state = None
+        if row and row[3] == "finished":
+            self.stream_state = row[3]
+        elif row and row[3]:
+            self.stream_state = tuple(int(value) for value in row[3].split())
+
+    def save(self, lanes, offset, counts=None, stream_state=None):
+        self.lanes = list(lanes)
+        self.offset = offset
+        self.counts = list(counts or [None] * len(self.lanes))
+        self.stream_state = stream_state
+        with DB_LOCK:
+            self.connection.execute("INSERT OR IGNORE INTO {}_jobs (Run_ID, "
+                                    "Name) VALUES (?, ?)"
+                                    .format(self.table_name), 
+                                    (self.run_id, self.name))
+            self.connection.execute("UPDATE {}_jobs SET Lanes_Done = ?, "
+                                    "Output_Size = ?, Lane_Counts = ?, "
+                                    "Stream_State = ?, Updated = ? WHERE "
+                                    "Run_ID = ? AND Name = ?"
+                                    .format(self.table_name),
+                                    ("\n".join(self.lanes), offset,
+                                     "\n".join("{} {}".format(*count) if count 
+                                               else "" for count 
+                                               in self.counts),
+                                     stream_state if stream_state in 
+                                     (None, "finished") else 
+                                     " ".join(str(value) for value 
+                                              in stream_state),
+                                     time(), self.run_id, self.name))
+            self.connection.commit()
+
+    def save_output(self, totals, output_md5):
+        """
+        Record the (records, bases) totals, or None if they were not counted,
+        and the md5 sum of the finished output.
+        """
+        records, bases = totals or (None, None)
+        with DB_LOCK:
+            self.connection.execute("UPDATE {}_jobs SET Records = ?, Bases = "
+                                    "?, Output_MD5 = ? WHERE Run_ID = ? AND "
+                                    "Name = ?".format(self.table_name),
+                                    (records, bases, output_md5, self.run_id,
+                                     self.name))
+            self.connection.commit()
+
+def create_post_table(connection, table_name):
+    """
+    Create the table of the post-merge stage, with one row for every
+    notification to send and every set of input files to delete, and the
+    attempts made at it (see PostMerge).
+    """
     conn_cursor = connection.cursor()
-    selection = conn_cursor.execute("SELECT * FROM {} {} {} = '{}'"
-                                    .format(table_name, select_type, 
-                                            column_name, selection))
-    return selection.fetchall()
+    conn_cursor.execute("CREATE TABLE IF NOT EXISTS {}_post (Post_ID integer "
+                        "PRIMARY KEY, Run_ID text, Kind text, Name text, "
+                        "Target text, Subject text, Body text, Status text, "
+                        "Attempts int, Error text, Claim text, Host text, "
+                        "Created real, Updated real)".format(table_name))
+    conn_cursor.execute("CREATE INDEX IF NOT EXISTS {0}_post_status ON "
+                        "{0}_post (Kind, Status)".format(table_name))
+    conn_cursor.execute("CREATE INDEX IF NOT EXISTS {0}_post_claim ON "
+                        "{0}_post (Claim)".format(table_name))
+    connection.commit()
+
+def queue_post(connection, table_name, kind, run_id, name, target, subject,
+               body):
+    """
+    Queue a notification (kind mail, to the address target) or the deletion
+    of the input files of a merged file (kind delete, target is the merged
+    file and body the input files) in the post table.
+    """
+    now = time()
+    with DB_LOCK:
+        connection.execute("INSERT INTO {}_post (Run_ID, Kind, Name, Target, "
+                           "Subject, Body, Status, Attempts, Created, Updated) "
+                           "VALUES (?, ?, ?, ?, ?, ?, 'Queued', 0, ?, ?)"
+                           .format(table_name), 
+                           (run_id, kind, name, target, subject, body, now,
+                            now))
+        connection.commit()
 
+def claim_posts(connection, table_name, kind, retry_seconds, stale_seconds):
+    """
+    Claim the work of kind in the post table that is due: work that has not
+    been tried yet, work that failed at least retry_seconds ago, and work
+    left behind stale_seconds ago by a process that stopped in the middle of
+    it. Returns the claimed rows as (Post_ID, Run_ID, Name, Target, Subject,
+    Body).
+    """
+    claim = uuid.uuid4().hex
+    now = time()
+    with DB_LOCK:
+        connection.execute("UPDATE {}_post SET Status = 'Working', Claim = ?, "
+                           "Host = ?, Updated = ? WHERE Kind = ? AND ((Status "
+                           "= 'Queued' AND (Attempts = 0 OR Updated <= ?)) OR "
+                           "(Status = 'Working' AND Updated <= ?))"
+                           .format(table_name), 
+                           (claim, node_name(), now, kind, now - retry_seconds,
+                            now - stale_seconds))
+        connection.commit()
+        return connection.execute("SELECT Post_ID, Run_ID, Name, Target, "
+                                  "Subject, Body FROM {}_post WHERE Claim = ? "
+                                  "ORDER BY Post_ID".format(table_name),
+                                  (claim,)).fetchall()
 
-def main(config_file):
-    
+def release_posts(connection, table_name, post_ids, error, max_attempts):
+    """
+    Record the outcome of claimed work in the post table. Work that failed is
+    queued again until it has been tried max_attempts times, and is then
+    marked as Failed. Returns True if any of it failed for good.
+    """
+    with DB_LOCK:
+        if error is None:
+            connection.executemany("UPDATE {}_post SET Status = 'Done', "
+                                   "Attempts = Attempts + 1, Error = NULL, "
+                                   "Claim = NULL, Updated = ? WHERE Post_ID = "
+                                   "?".format(table_name),
+                                   [(time(), post_id) for post_id in post_ids])
+        else:
+            connection.executemany("UPDATE {}_post SET Status = CASE WHEN "
+                                   "Attempts + 1 < ? THEN 'Queued' ELSE "
+                                   "'Failed' END, Attempts = Attempts + 1, "
+                                   "Error = ?, Claim = NULL, Updated = ? WHERE "
+                                   "Post_ID = ?".format(table_name),
+                                   [(max_attempts, error, time(), post_id) 
+                                    for post_id in post_ids])
+        connection.commit()
+        return error is not None and any(
+            connection.execute("SELECT Status FROM {}_post WHERE Post_ID = ?"
+                               .format(table_name), 
+                               (post_id,)).fetchone()[0] == "Failed"
+            for post_id in post_ids)
+
+def validate_output(connection, table_name, run_id, name, out_path, samples):
+    """
+    Raise a ValueError unless the merge job name of run_id is Done, out_path
+    has the size recorded for it and every file in samples was merged into
+    it.
+    """
+    with DB_LOCK:
+        row = connection.execute("SELECT Status, Output_Size, Lanes_Done "
+                                 "FROM {}_jobs WHERE Run_ID = ? AND Name = ?"
+                                 .format(table_name), 
+                                 (run_id, name)).fetchone()
+    if row is None or row[0] != "Done":
+        raise ValueError("{} has not been merged.".format(name))
+    size = os.path.getsize(out_path)
+    if size != row[1]:
+        raise ValueError("{} is {} bytes, but was {} bytes when it was merged."
+                         .format(out_path, size, row[1]))
+    lanes = (row[2] or "").split("\n")
+    missing = [sample for sample in samples 
+               if os.path.basename(sample) not in lanes]
+    if missing:
+        raise ValueError("{} were not merged into {}.".format(
+            ", ".join(missing), out_path))
+
+class PostMerge(object):
+    """
+    Background stage that deletes the input files of merged files, once the
+    merged file has been checked (see validate_output), and sends the
+    notifications of a pass, as one digest per run and address. The work is
+    queued in the post table of the run database, so the merge workers never
+    wait for it, and every attempt and error is recorded there. Work that
+    fails is tried again after retry_seconds, in this pass or a later one,
+    until it has been tried max_attempts times; the admin is told about
+    input files that could not be deleted. Deletions are done as they come
+    in, notifications when the stage is stopped at the end of the pass.
+    """
+
+    def __init__(self, connection, table_name, admin, max_attempts=3,
+                 retry_seconds=300, stale_seconds=300):
+        self.connection = connection
+        self.table_name = table_name
+        self.admin = admin
+        self.max_attempts = max_attempts
+        self.retry_seconds = retry_seconds
+        self.stale_seconds = stale_seconds
+        self.wakeup = threading.Event()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+
+    def notify(self, run, address, subject, message):
+        queue_post(self.connection, self.table_name, "mail", run, None,
+                   address, subject, message)
+
+    def delete(self, run, name, out_path, samples):
+        """
+        Queue the deletion of samples, which are relative to run, once
+        out_path, the merged file name, has been checked.
+        """
+        queue_post(self.connection, self.table_name, "delete", run, name,
+                   out_path, None, "\n".join(samples))
+        self.wakeup.set()
+
+    def deleting(self):
+        """
+        Return True if there are input files waiting to be deleted for the
+        first time.
+        """
+        with DB_LOCK:
+            return self.connection.execute("SELECT COUNT(*) FROM {}_post "
+                                           "WHERE Kind = 'delete' AND Status "
+                                           "IN ('Queued', 'Working') AND "
+                                           "Attempts = 0"
+                                           .format(self.table_name)
+                                           ).fetchone()[0] > 0
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        """
+        Finish the queued deletions, send the notifications and wait for the
+        stage to end.
+        """
+        self.stopped.set()
+        self.wakeup.set()
+        self.thread.join()
+
+    def _run(self):
+        while True:
+            self.wakeup.wait(self.retry_seconds)
+            self.wakeup.clear()
+            stopping = self.stopped.is_set()
+            try:
+                self.delete_inputs()
+                if stopping:
+                    self.send_digests()
+            except sqlite3.Error:
+                logging.error("The post-merge stage could not use the run "
+                              "database.", exc_info = True)
+            if stopping:
+                return
+
+    def delete_inputs(self):
+        for post_id, run, name, out_path, subject, body in claim_posts(
+                self.connection, self.table_name, "delete", 
+                self.retry_seconds, self.stale_seconds):
+            samples = body.split("\n") if body else []
+            error = None
+            try:
+                validate_output(self.connection, self.table_name, run, name,
+                                out_path, samples)
+                with measure("delete", run, name):
+                    delete_samples(run, samples)
+                logging.info("Deleted the {} input files of {}."
+                             .format(len(samples), out_path))
+            except (IOError, OSError, ValueError) as e:
+                error = str(e)
+                logging.error("Could not delete the input files of {}: {}"
+                              .format(out_path, error))
+            if release_posts(self.connection, self.table_name, [post_id],
+                             error, self.max_attempts):
+                self.notify(run, self.admin, "Input files were not deleted",
+                            "The input files of {} were not deleted after "
+                            "{} attempts: {}".format(out_path, 
+                                                     self.max_attempts, error))
+
+    def send_digests(self):
+        batches = {}
+        for post_id, run, name, address, subject, body in claim_posts(
+                self.connection, self.table_name, "mail", self.retry_seconds,
+                self.stale_seconds):
+            batches.setdefault((run or "", address), []).append(
+                (post_id, subject, body))
+        for (run, address), notes in sorted(batches.items()):
+            msg = digest_message(run, address, [(subject, body) for 
+                                                post_id, subject, body 
+                                                in notes])
+            error = None
+            try:
+                with measure("notify", run) as stage:
+                    deliver(msg)
+                    stage.bytes_written = len(msg.as_string())
+                logging.info("Email with {} messages sent to {}"
+                             .format(len(notes), address))
+            except (IOError, OSError) as e:
+                error = str(e)
+                logging.error("Could not send email to {}: {}"
+                              .format(address, error))
+            if release_posts(self.connection, self.table_name,
+                             [note[0] for note in notes], error, 
+                             self.max_attempts):
+                logging.error("Gave up sending {} messages to {}."
+                              .format(len(notes), address))
+
+def import_completed_file(connection, table_name, dirPath):
+    """
+    Import the runs listed in the .completed file used by older versions of
+    the script into the run database. The file is renamed to
+    .completed.imported afterwards, so that this only happens once.
+    """
+    if not check(dirPath, ".completed"):
+        return
+    with open(os.path.join(dirPath, ".completed"), "r") as f:
+        runs = [line.strip() for line in f if line.strip()]
+    with DB_LOCK:
+        connection.executemany("INSERT OR IGNORE INTO {} (Run_ID, Name, "
+                               "Status, Updated) VALUES (?, ?, 'Completed', "
+                               "?)".format(table_name),
+                               [(run, os.path.basename(run), time()) 
+                                for run in runs])
+        connection.commit()
+    os.rename(os.path.join(dirPath, ".completed"),
+              os.path.join(dirPath, ".completed.imported"))
+    logging.info("Imported {} completed runs from {}".format(
+        len(runs), os.path.join(dirPath, ".completed")))
+
+def create_md5_cache_table(connection, table_name):
+    """
+    Create the table that remembers which files have passed the md5 check,
+    so that they are not hashed again on the next run of the script.
+    """
+    conn_cursor = connection.cursor()
+    conn_cursor.execute("CREATE TABLE IF NOT EXISTS {}_md5_cache (Path text "
+                        "PRIMARY KEY, Run_ID text, Size int, Mtime real, "
+                        "Inode int, Digest text)".format(table_name))
+    conn_cursor.execute("CREATE INDEX IF NOT EXISTS {0}_md5_cache_run ON "
+                        "{0}_md5_cache (Run_ID)".format(table_name))
+    connection.commit()
+
+def load_md5_cache(connection, table_name, run_id):
+    """
+    Return the files of run_id that have passed the md5 check before, in the
+    form {path: (size, mtime, inode, digest)}.
+    """
+    with DB_LOCK:
+        rows = connection.execute("SELECT Path, Size, Mtime, Inode, Digest "
+                                  "FROM {}_md5_cache WHERE Run_ID = ?"
+                                  .format(table_name), (run_id,)).fetchall()
+    return dict((row[0], tuple(row[1:])) for row in rows)
+
+def store_md5_cache(connection, table_name, run_id, cache):
+    """
+    Save the verified files in cache (see load_md5_cache) for run_id.
+    """
+    with DB_LOCK:
+        connection.executemany("INSERT OR REPLACE INTO {}_md5_cache (Path, "
+                               "Run_ID, Size, Mtime, Inode, Digest) VALUES (?, "
+                               "?, ?, ?, ?, ?)".format(table_name),
+                               [(path, run_id) + entry 
+                                for path, entry in cache.items()])
+        connection.commit()
+
+def evict_md5_cache(connection, table_name, run_ids=None):
+    """
+    Forget the verified files of runs that have been merged. If run_ids is
+    None, the files of every completed run are forgotten.
+    """
+    with DB_LOCK:
+        if run_ids is None:
+            connection.execute("DELETE FROM {0}_md5_cache WHERE Run_ID IN "
+                               "(SELECT Run_ID FROM {0} WHERE Status = "
+                               "'Completed')".format(table_name))
+        else:
+            connection.executemany("DELETE FROM {}_md5_cache WHERE Run_ID = ?"
+                                   .format(table_name), 
+                                   [(run_id,) for run_id in run_ids])
+        connection.commit()
+
+def create_metrics_table(connection, table_name):
+    """
+    Create the table that holds the time and I/O of every stage, per run,
+    merged file (Name, which is empty for stages that work on the whole run)
+    and host (see metrics.py).
+    """
+    conn_cursor = connection.cursor()
+    conn_cursor.execute("CREATE TABLE IF NOT EXISTS {}_metrics (Run_ID text, "
+                        "Name text, Stage text, Host text, Runs int, Seconds "
+                        "real, CPU_Seconds real, Bytes_Read int, Bytes_Written "
+                        "int, Updated real, PRIMARY KEY (Run_ID, Name, Stage, "
+                        "Host))".format(table_name))
+    conn_cursor.execute("CREATE INDEX IF NOT EXISTS {0}_metrics_updated ON "
+                        "{0}_metrics (Updated)".format(table_name))
+    connection.commit()
+
+def store_metrics(connection, table_name, rows):
+    """
+    Add the stage totals in rows (see metrics.Metrics.take) to the metrics
+    table.
+    """
+    if not rows:
+        return
+    now = time()
+    host = node_name()
+    with DB_LOCK:
+        connection.executemany("INSERT OR IGNORE INTO {}_metrics (Run_ID, "
+                               "Name, Stage, Host, Runs, Seconds, CPU_Seconds, "
+                               "Bytes_Read, Bytes_Written) VALUES (?, ?, ?, ?, "
+                               "0, 0, 0, 0, 0)".format(table_name),
+                               [row[:3] + (host,) for row in rows])
+        connection.executemany("UPDATE {}_metrics SET Runs = Runs + ?, "
+                               "Seconds = Seconds + ?, CPU_Seconds = "
+                               "CPU_Seconds + ?, Bytes_Read = Bytes_Read + ?, "
+                               "Bytes_Written = Bytes_Written + ?, Updated = ? "
+                               "WHERE Run_ID = ? AND Name = ? AND Stage = ? "
+                               "AND Host = ?".format(table_name),
+                               [row[3:] + (now,) + row[:3] + (host,)
+                                for row in rows])
+        connection.commit()
+
+def load_metrics(connection, table_name, since=0):
+    """
+    Return the totals of every stage of the runs that have been worked on
+    since the time since, in the form (run, stage, runs, seconds, cpu
+    seconds, bytes read, bytes written).
+    """
+    with DB_LOCK:
+        return connection.execute("SELECT Run_ID, Stage, SUM(Runs), "
+                                  "SUM(Seconds), SUM(CPU_Seconds), "
+                                  "SUM(Bytes_Read), SUM(Bytes_Written) FROM "
+                                  "{0}_metrics WHERE Run_ID IN (SELECT Run_ID "
+                                  "FROM {0}_metrics WHERE Updated >= ?) GROUP "
+                                  "BY Run_ID, Stage ORDER BY Run_ID, Stage"
+                                  .format(table_name), (since,)).fetchall()
+
+def write_output_md5sums(connection, table_name, run_id, out_dir):
+    """
+    Write the md5 sums of the merged files of run_id, computed while they
+    were merged, to md5sums.txt in out_dir.
+    """
+    with DB_LOCK:
+        rows = connection.execute("SELECT Name, Output_MD5 FROM {}_jobs WHERE "
+                                  "Run_ID = ? AND Output_MD5 IS NOT NULL"
+                                  .format(table_name), (run_id,)).fetchall()
+    if not rows:
+        return
+    try:
+        write_md5sums(out_dir, dict((name + ".gz", digest) 
+                                    for name, digest in rows))
+    except (IOError, OSError):
+        logging.error("Could not write md5sums.txt in {}".format(out_dir),
+                      exc_info = True)
+
+def select_from_db(connection, table_name, column_name, selection, select_type):
+    """
+    Return the rows of table_name where column_name is (select_type WHERE)
+    or is not (select_type WHERE NOT) equal to selection.
+    """
+    if column_name not in DB_COLUMNS or select_type not in ("WHERE",
+                                                            "WHERE NOT"):
+        raise ValueError("Invalid selection on column {}".format(column_name))
+    with DB_LOCK:
+        conn_cursor = connection.cursor()
+        selection = conn_cursor.execute("SELECT * FROM {} {} {} = ?"
+                                        .format(table_name, select_type, 
+                                                column_name), (selection,))
+        return selection.fetchall()
+
+
+def load_config(config_file):
+    """
+    Load and check the config file. Exits if it is missing or malformed.
+    """
     if not (config_file is None or os.path.isfile(config_file)):
         default_logger("Config file not supplied. Please supply one with the "
         "--config_file argument. {} UTC"
@@ -328,58 +2268,93 @@ def main(config_file):
     
     try:
         with open(config_file, "r") as config_file_:
-            config_ = yaml.load(config_file_)     
+            config_ = yaml.safe_load(config_file_)     
     except Exception as e:
         default_logger("There was an error parsing the config file. {} at {}"
-                       .format(e.message, strftime("%H:%M:%S, %A, %B %d, %Y",
-                                                   gmtime())))
+                       .format(e, strftime("%H:%M:%S, %A, %B %d, %Y",
+                                           gmtime())))
         sys.exit(1)
     try:
         check_config(config_)      
-    except KeyError as e:
-        print (e.message)
+        config_["compression_settings"] = compression_settings(config_)
+    except (KeyError, ValueError) as e:
+        print (str(e))
         sys.exit(1)
-    
-    logging.basicConfig(filename=os.path.join(config_["logging"]["log_file"]),
-                        level = logging.INFO)
-    logging.info("\n")
-    logging.info("Merging script started at {}".
-                 format(strftime("%H:%M:%S, %A, %B %d, %Y", gmtime())))
+    return config_
 
-    logging.info("Config file loaded and parsed successfully at {}."
-                       .format(strftime("%H:%M:%S, %A, %B %d, %Y",gmtime())))      
-    Inbox = config_["runs"]["runs_folder"]
-    logging.info("Base runs folder is {}".format(Inbox))
-    
-    logging.info("Connecting to run database: {}".format(config_["database"]
-                                                         ["name"]))
-    conn = connect_to_db(config_["database"]["location"],
-                         config_["database"]["name"])
-    
-    check_db_table(conn, config_["database"]["table_name"])
-    
-    running_pids = get_running_pid(config_["users"]["user"])
-    
-    print running_pids
-    
-    not_completed = select_from_db(conn, "ST_Run_Combiner_Data", "Status",
-                                   "Completed", "WHERE NOT")
-    completed = select_from_db(conn, "ST_Run_Combiner_Data", "Status",
-                               "Completed", "WHERE")
+def process_runs(config_, conn, completed, directories, select=None):
+    """
+    Verify the runs in directories that are not in completed and queue their
+    merge jobs, then work on the queued jobs of all runs, including those
+    queued by other processes or nodes, until none are left. Runs that
+    finish merging are added to completed and returned. Runs left behind by
+    processes that have stopped are reset first (see reset_stale_runs).
+    Input files are deleted, and notifications sent, by a PostMerge stage
+    that is finished at the end of the pass. select limits the jobs that are
+    worked on (see work_queue).
+    """
+    table_name = config_["database"]["table_name"]
+    scheduler = config_.get("scheduler") or {}
+    reset_stale_runs(conn, table_name, scheduler.get("stale_seconds", 300))
+    heartbeat = Heartbeat(lambda run_ids: beat_runs(conn, table_name, run_ids),
+                          scheduler.get("heartbeat_seconds", 30))
+    post = PostMerge(conn, table_name, config_["email"]["admin"],
+                     config_["email"].get("max_attempts", 3),
+                     config_["email"].get("retry_seconds", 300),
+                     scheduler.get("stale_seconds", 300))
+    heartbeat.start()
+    post.start()
+    POST_MERGE[0] = post
+    try:
+        locks = {}
+        try:
+            plan_runs(config_, conn, completed, directories, heartbeat, locks)
+        finally:
+            for run, lock in locks.items():
+                heartbeat.remove(run)
+                lock.release()
+        work_queue(config_, conn, post, select)
+        return finish_runs(config_, conn, completed)
+    finally:
+        heartbeat.stop()
+        POST_MERGE[0] = None
+        post.stop()
+        save_metrics(config_, conn)
 
-    print not_completed
-    print completed
+def save_metrics(config_, conn):
+    """
+    Save the stage measurements made since the last call in the run database
+    and, if textfile is set in the metrics section of the config file, write
+    the totals of the runs worked on in the last window_hours (default 24),
+    by any process, to it in the Prometheus text format.
+    """
+    table_name = config_["database"]["table_name"]
+    store_metrics(conn, table_name, METRICS.take())
+    section = config_.get("metrics") or {}
+    if not section.get("textfile"):
+        return
+    since = time() - section.get("window_hours", 24) * 3600
+    try:
+        write_textfile(section["textfile"], 
+                       load_metrics(conn, table_name, since))
+    except (IOError, OSError):
+        logging.error("Could not write the metrics to {}."
+                      .format(section["textfile"]), exc_info = True)
 
-    
-    for item in running_pids:
-        print [a for a in not_completed if item in not_completed]
-    '''
-    runs_file = check(Inbox, ".completed")
-    if not runs_file:
-        open(os.path.join(config_["runs"]["runs_folder"],".completed"),
-             "a+").close() 
-    completed = get_completed(Inbox)
-    directories = list_dir_no_hidden(Inbox)
+def plan_runs(config_, conn, completed, directories, heartbeat, locks):
+    """
+    Verify the runs in directories that are not in completed, and queue the
+    merge jobs of the runs that are ready. Every run that is verified is
+    locked with a RunLock, which is added to locks, and kept alive by
+    heartbeat. Runs that are locked by, or recorded as being verified by,
+    another live process are skipped, and so are runs that are already
+    being merged.
+    """
+    table_name = config_["database"]["table_name"]
+    scheduler = config_.get("scheduler") or {}
+    stale_seconds = scheduler.get("stale_seconds", 300)
+    lock_dir = os.path.join(config_["runs"]["runs_folder"],
+                            ".run_combiner_locks")
     permissions = [check_permissions(directory) for directory in directories 
                    if directory not in completed]
                    
@@ -393,28 +2368,73 @@ def main(config_file):
     for directory in unwritable_directories:
         subject = "Unwritable directories that are not completed" 
         message = "The directory {} is unwritable. ".format(directory[0])
-        send_mail(subject, message, config_["email"]["admin"])
+        send_mail(subject, message, config_["email"]["admin"], directory[0])
         logging.warning(message)
     
     logging.info("List of runs to merge: {}".format([dir_[0] for dir_ in 
                                                      writable_directories]))
+    statuses = get_run_statuses(conn, table_name)
+    scan_stats = ScanStats()
     for directory in writable_directories:
+        if statuses.get(directory[0]) == "Merging":
+            logging.info("{} is already being merged.".format(directory[0]))
+            continue
         logging.info("Working on {}".format(directory[0]))
         
+        lock = RunLock(lock_dir, directory[0])
+        if (run_owned_elsewhere(conn, table_name, directory[0], 
+                                stale_seconds) or not lock.acquire()):
+            logging.info("{} is being worked on by another process, skipping "
+                         "it.".format(directory[0]))
+            continue
+        locks[directory[0]] = lock
+        heartbeat.add(directory[0])
+        
         md5status = 1
         timestamp = 1
+        md5_results = {}
+        md5sums = None
+        set_run_status(conn, table_name, directory[0], "Verifying")
         
         try:
-            if config_["verify_transfer"]["use_md5"]:
-                logging.info("Using md5sums to verify transfer.")
-                md5status = check_md5(os.path.join(directory[0],
-                                               config_["runs"]["in_folder"]),
-                                      config_["verify_transfer"]["md5_path"])
-            else:
-                logging.info("Using timestamps to verify transfer.")
-                timestamp = check_timestamps(os.path.join(directory[0],
-                                              config_["runs"]["in_folder"]),
-                                             time())
+            with measure("scan", directory[0]):
+                run_index = index_run(directory[0], 
+                                      config_["runs"]["in_folder"], scan_stats)
+            if config_["runs"].get("incremental"):
+                plan_incremental_run(config_, conn, run_index)
+                continue
+            with measure("verify", directory[0]) as stage:
+                if (config_["verify_transfer"]["use_md5"] and
+                        config_["verify_transfer"].get("verify_during_merge")):
+                    logging.info("Using md5sums to verify transfer while "
+                                 "merging.")
+                    if "md5sums.txt" in run_index:
+                        md5sums = read_md5sums(run_index.in_dir)
+                        md5_results = dict((name, "MISSING") for name 
+                                           in md5sums if name not in run_index)
+                        if md5sums and not md5_results:
+                            md5status = 0
+                elif config_["verify_transfer"]["use_md5"]:
+                    logging.info("Using md5sums to verify transfer.")
+                    md5_cache = load_md5_cache(conn, table_name, directory[0])
+                    cached = dict(md5_cache)
+                    md5_results = check_md5(run_index.in_dir,
+                                            config_["verify_transfer"].get(
+                                                "md5_workers", 4),
+                                            config_["verify_transfer"].get(
+                                                "stop_at_first_mismatch", 
+                                                False),
+                                            md5_cache, run_index.stat_cache())
+                    store_md5_cache(conn, table_name, directory[0], md5_cache)
+                    stage.bytes_read = hashed_bytes(run_index.in_dir, 
+                                                    md5_results, cached,
+                                                    run_index.stat_cache())
+                    if md5_results and all(status == "OK" for status 
+                                           in md5_results.values()):
+                        md5status = 0
+                else:
+                    logging.info("Using timestamps to verify transfer.")
+                    timestamp = check_timestamps(run_index, time())
             
             if md5status == 0 or timestamp == 0:
                 if md5status == 0:
@@ -423,31 +2443,33 @@ def main(config_file):
                 else:
                     logging.info("Timestamps for {} are good, proceeding"
                                  .format(directory[0]))
-                files_for_merging = files_to_be_merged(os.path.join(
-                    directory[0],config_["runs"]["in_folder"]))
                 ss_info = parse_sample_sheet(directory[0],
                                              config_["email"]["admin"],
                                              config_["email"]["use_ss_email"])
-                sample_groups = group_samples(directory, files_for_merging)
-                for key in sample_groups:
-                    for value in sample_groups[key]:
-                        for item in value:
-                            merge_files(key, item,
-                                        config_["runs"]["keep_original_files"],
-                                        config_["email"]["admin"],
-                                        config_["runs"]["in_folder"],
-                                        config_["runs"]["out_folder"],
-                                        ss_info[0])
-                    update_completed(directory[0], Inbox)
-                    logging.info("Merging completed on {}".format(directory[0]))
+                try:
+                    run_jobs = build_merge_jobs(directory[0], 
+                                                run_index.samples,
+                                                ss_info[0], md5sums)
+                except ValueError as e:
+                    reject_run(config_, conn, directory[0], str(e))
+                    continue
+                queue_jobs(conn, table_name, run_jobs)
+                set_run_status(conn, table_name, directory[0], "Merging",
+                               ss_info[1])
             else:
                 subject = "Non matching md5 sums or timestamps too young"
                 message = ("Either the md5 sum for {} is not correct, or the "
                            "timestamp is too recent. Files are still copying "
                            "or an error has occurred during copying."
                            .format(directory[0]))
-                send_mail(subject, message, config_["email"]["admin"])
+                bad_files = ["{}: {}".format(name, status) for name, status
+                             in sorted(md5_results.items()) if status != "OK"]
+                if bad_files:
+                    message += "\n" + "\n".join(bad_files)
+                send_mail(subject, message, config_["email"]["admin"],
+                          directory[0])
                 logging.warning(message)
+                set_run_status(conn, table_name, directory[0], "Waiting")
         except ValueError:
             logging.error("Popen has been called with invalid arguments. {} UTC"
                           .format(strftime("%H:%M:%S, %A, %B %d, %Y",gmtime())),
@@ -463,25 +2485,561 @@ def main(config_file):
                           "to does not exist. {}."
                           .format(strftime("%H:%M:%S, %A, %B %d, %Y",
                                            gmtime())), exc_info = True)
-        
-        subject = "Run finished merging."
-        msg = ("The run {} has finished merging. Feel free to start work on "
-               "it at any time.".format(directory[0]))
-        send_mail(subject, msg, ss_info[1])
-        
+    scan_stats.log()
+
+def plan_incremental_run(config_, conn, run_index):
+    """
+    Queue the merge jobs of run in incremental mode. Every lane file is
+    checked on its own, against md5sums.txt or by its age, and the files of
+    each sample and read are merged in lane order up to the first one that is
+    not ready yet. A job is final, and its output is finished, when all the
+    files expected for it are ready: those listed in md5sums.txt or, when
+    timestamps are used, those of the lanes the sample is on in the Lane
+    column of the sample sheet (all the lanes in it for undetermined reads)
+    and at least expected_lanes of them. Without either, a job is never
+    final, as a lane that has not started to arrive can not be told from one
+    that will never come. Returns True if any files were queued. run_index is
+    the RunIndex of the run (see run_index.index_run).
+    
+    With verify_during_merge the files are not hashed here, as they are
+    checked against md5sums.txt while they are merged; a file listed there is
+    ready once it is present and old enough to have been copied in full.
+    """
+    table_name = config_["database"]["table_name"]
+    verify = config_["verify_transfer"]
+    run = run_index.path
+    in_dir = run_index.in_dir
+    present = run_index.fastq_names()
+    md5sums = None
+    expected = None
+    if verify["use_md5"]:
+        if "md5sums.txt" not in run_index:
+            logging.info("Waiting for md5sums.txt in {}.".format(in_dir))
+            set_run_status(conn, table_name, run, "Waiting")
+            return False
+        now = time()
+        with measure("verify", run) as stage:
+            md5sums = read_md5sums(in_dir)
+            if verify.get("verify_during_merge"):
+                ready = set(name for name in md5sums if name in present and 
+                            now - run_index.files[name].mtime >= 
+                            SETTLED_SECONDS)
+            else:
+                md5_cache = load_md5_cache(conn, table_name, run)
+                cached = dict(md5_cache)
+                statuses = check_md5(in_dir, verify.get("md5_workers", 4), 
+                                     False, md5_cache, run_index.stat_cache())
+                store_md5_cache(conn, table_name, run, md5_cache)
+                stage.bytes_read = hashed_bytes(in_dir, statuses, cached, 
+                                                run_index.stat_cache())
+                ready = set(name for name, status in statuses.items() 
+                            if status == "OK")
+        files = sorted(set(present) | set(name for name in md5sums 
+                                          if name.endswith(".gz")))
+    else:
+        now = time()
+        with measure("verify", run):
+            ready = set(name for name in present if now - 
+                        run_index.files[name].mtime >= SETTLED_SECONDS)
+        files = present
+        expected = config_["runs"].get("expected_lanes")
+    
+    ss_info = parse_sample_sheet(run, config_["email"]["admin"],
+                                 config_["email"]["use_ss_email"])
+    try:
+        jobs = build_merge_jobs(run, group_files(files, run_index.lanes),
+                                ss_info[0],
+                                md5sums if verify.get("verify_during_merge") 
+                                else None)
+    except ValueError as e:
+        reject_run(config_, conn, run, str(e))
+        return False
+    sheet_lanes = ss_info[2]
+    all_lanes = set(lane for lanes in sheet_lanes.values() for lane in lanes)
+    unknown = []
+    for job in jobs:
+        lanes = []
+        for sample in job["samples"]:
+            if sample not in ready:
+                break
+            lanes.append(sample)
+        if md5sums is not None:
+            job["final"] = len(lanes) == len(job["samples"])
+        else:
+            number = parse_fastq_name(job["samples"][0]).number
+            wanted = sheet_lanes.get(number) if number else all_lanes
+            merged = set(parse_fastq_name(name).lane for name in lanes)
+            if 0 in merged:
+                # Lanes were not split, so the one file holds all of them.
+                job["final"] = len(lanes) == len(job["samples"])
+            elif wanted or expected:
+                job["final"] = (len(lanes) == len(job["samples"]) and
+                                (not wanted or wanted <= merged) and
+                                (not expected or len(merged) >= expected))
+            else:
+                job["final"] = False
+                unknown.append(job["name"])
+        job["samples"] = lanes
+        job["sizes"] = job["sizes"][:len(lanes)]
+    if unknown:
+        logging.warning("The sample sheet of {} has no lanes for {}, and "
+                        "expected_lanes is not set, so they are not finished "
+                        "until it is.".format(run, ", ".join(unknown)))
+    queue_jobs(conn, table_name, jobs)
+    queued = [job for job in jobs if job["samples"]]
+    logging.info("{} of {} files of {} are ready to be merged.".format(
+        len(ready), len(files), run))
+    set_run_status(conn, table_name, run, "Merging" if queued else "Waiting",
+                   ss_info[1])
+    return bool(queued)
+
+def finish_runs(config_, conn, completed):
+    """
+    Look at every run that is being merged, and mark those with no queued or
+    running jobs left as Completed, or as Failed if any of their jobs failed
+    for good. Runs with Partial jobs go back to Waiting until more of their
+    files have arrived. Whichever process gets to a run first sends the email
+    about it.
+    Runs that were completed, by this or any other process, are added to
+    completed and returned.
+    """
+    table_name = config_["database"]["table_name"]
+    with DB_LOCK:
+        rows = conn.execute("SELECT {0}.Run_ID, {0}.Email, {0}_jobs.Name, "
+                            "{0}_jobs.Status, {0}_jobs.Error FROM {0} LEFT "
+                            "JOIN {0}_jobs ON {0}_jobs.Run_ID = {0}.Run_ID "
+                            "WHERE {0}.Status = 'Merging'"
+                            .format(table_name)).fetchall()
+    runs = {}
+    for run, email_, name, status, error in rows:
+        runs.setdefault(run, (email_, []))[1].append((name, status, error))
+    for run, (email_, jobs) in runs.items():
+        if any(status in ("Queued", "Running") for name, status, error 
+               in jobs):
+            continue
+        failed = [(name, error) for name, status, error in jobs 
+                  if name is not None and status not in ("Done", "Partial")]
+        if not failed and any(status == "Partial" for name, status, error 
+                              in jobs):
+            if finish_run(conn, table_name, run, "Waiting"):
+                logging.info("Merged the files of {} that have arrived so "
+                             "far.".format(run))
+            continue
+        if failed:
+            if finish_run(conn, table_name, run, "Failed"):
+                subject = "Run failed merging."
+                message = ("The following merges failed for the run {}:\n{}"
+                           .format(run, "\n".join("{}: {}".format(name, error)
+                                                  for name, error in failed)))
+                send_mail(subject, message, config_["email"]["admin"], run)
+                logging.warning(message)
+            continue
+        if finish_run(conn, table_name, run, "Completed"):
+            evict_md5_cache(conn, table_name, [run])
+            if config_["runs"].get("output_md5"):
+                write_output_md5sums(conn, table_name, run,
+                                     os.path.join(run, 
+                                                  config_["runs"]["out_folder"]))
+            logging.info("Merging completed on {}".format(run))
+            subject = "Run finished merging."
+            msg = ("The run {} has finished merging. Feel free to start work "
+                   "on it at any time.".format(run))
+            send_mail(subject, msg, email_ or config_["email"]["admin"], run)
+    completed_runs = sorted(get_completed(conn, table_name) - completed)
+    completed.update(completed_runs)
+    return completed_runs
+
+def run_daemon(config_, conn, completed):
+    """
+    Keep running and watch the runs folder, and the input folder of every run
+    that is not completed, for changes. A run is verified and merged as soon
+    as it has not changed for settle_seconds and, when md5 sums are used,
+    its md5sums.txt is there. Runs that can not be merged yet are tried again
+    when they change, or after retry_seconds. An error in a pass is logged
+    and mailed to the admin, and the runs of the pass are tried again in the
+    same way, so that the daemon keeps running.
+    """
+    Inbox = config_["runs"]["runs_folder"]
+    daemon = config_.get("daemon") or {}
+    settle_seconds = daemon.get("settle_seconds", 60)
+    retry_seconds = daemon.get("retry_seconds", 3600)
+    from watcher import open_watcher
+    watcher = open_watcher(daemon.get("poll_seconds", 60))
+    watcher.add(Inbox)
+    last_change = {}
+    last_attempt = {}
+    for directory in list_dir_no_hidden(Inbox):
+        if directory not in completed:
+            last_change[directory] = 0
+    logging.info("Watching {} for runs to merge.".format(Inbox))
+    try:
+        while True:
+            for run in last_change:
+                for path in (run, os.path.join(run,
+                                               config_["runs"]["in_folder"])):
+                    if os.path.isdir(path):
+                        watcher.add(path)
+            now = time()
+            ready = []
+            for run in last_change:
+                in_dir = os.path.join(run, config_["runs"]["in_folder"])
+                if now - last_change[run] < settle_seconds:
+                    continue
+                if (config_["verify_transfer"]["use_md5"] and
+                        not check(in_dir, "md5sums.txt")):
+                    continue
+                if (last_change[run] >= last_attempt.get(run, -1) or
+                        now - last_attempt[run] >= retry_seconds):
+                    ready.append(run)
+            if ready:
+                for run in ready:
+                    last_attempt[run] = now
+                try:
+                    finished = process_runs(config_, conn, completed, ready)
+                except Exception as e:
+                    message = ("Merging {} failed with an error, and will be "
+                               "tried again in {} seconds: {}"
+                               .format(", ".join(ready), retry_seconds, e))
+                    logging.error(message, exc_info = True)
+                    try:
+                        send_mail("Error in the run combiner", message,
+                                  config_["email"]["admin"])
+                    except Exception:
+                        logging.error("Could not send the error email.",
+                                      exc_info = True)
+                    finished = []
+                for run in finished:
+                    del last_change[run]
+                    watcher.remove(os.path.join(run,
+                                                config_["runs"]["in_folder"]))
+                    watcher.remove(run)
+            
+            timeout = retry_seconds
+            for run in last_change:
+                if last_change[run] >= last_attempt.get(run, -1):
+                    timeout = min(timeout, max(1, last_change[run] +
+                                               settle_seconds - time()))
+                else:
+                    timeout = min(timeout, max(1, last_attempt[run] +
+                                               retry_seconds - time()))
+            for path in watcher.wait(timeout):
+                if path == Inbox:
+                    for directory in list_dir_no_hidden(Inbox):
+                        if (directory not in completed and 
+                                directory not in last_change):
+                            logging.info("New run {} found.".format(directory))
+                            last_change[directory] = time()
+                    continue
+                run = path if os.path.dirname(path) == Inbox else (
+                    os.path.dirname(path))
+                if run in last_change:
+                    last_change[run] = time()
+    finally:
+        watcher.close()
+
+def select_runs(runs_folder, names):
+    """
+    Return the paths of the runs called names, which are folder names in
+    runs_folder or paths to them. Raises a ValueError for a name that is not
+    a run in runs_folder.
+    """
+    runs = []
+    for name in names:
+        run = os.path.join(runs_folder, 
+                           os.path.basename(os.path.normpath(name)))
+        if not os.path.isdir(run):
+            raise ValueError("{} is not a run in {}.".format(name, 
+                                                             runs_folder))
+        if run not in runs:
+            runs.append(run)
+    return runs
+
+def job_filter(runs=None, samples=None):
+    """
+    Return a function select(run, lane files) that tells whether the merge
+    job of those lane files of run belongs to one of runs and one of
+    samples, or None if neither is given. A sample is given by its S number
+    (S1) or by the sample part of its file names.
+    """
+    if not runs and not samples:
+        return None
+    
+    def select(run, names):
+        if runs and run not in runs:
+            return False
+        if not samples:
+            return True
+        parsed = parse_fastq_name(names[0]) if names else None
+        return parsed is not None and (
+            "S{}".format(parsed.number) in samples or 
+            bool(parsed.sample) and parsed.sample in samples)
+    
+    return select
+
+def merge_rate(connection, table_name, merge_mode):
+    """
+    Return the bytes of input merged per second, per worker, by the merges
+    in merge_mode recorded in the metrics table, or None if there are none.
+    """
+    stages = (("concat",) if merge_mode == "concat" 
+              else ("decompress", "compress"))
+    with DB_LOCK:
+        row = connection.execute("SELECT SUM(CASE WHEN Stage = ? THEN "
+                                 "Bytes_Read ELSE 0 END), SUM(Seconds) FROM "
+                                 "{}_metrics WHERE Stage IN ({})"
+                                 .format(table_name, 
+                                         ", ".join("?" * len(stages))),
+                                 stages[:1] + stages).fetchone()
+    if row is None or not row[0] or not row[1]:
+        return None
+    return row[0] / float(row[1])
+
+def plan_merges(config_, conn, runs, samples=None):
+    """
+    Print the merge jobs that merging runs would run, without verifying or
+    changing anything: the lane files of every job, their size, and the
+    estimated size of its output (see merge_estimate) and the time it takes,
+    from the rate of earlier merges (see merge_rate). Jobs that are already
+    done, and jobs of other samples than samples, are left out. Returns 1
+    if the jobs of any of runs can not be worked out, otherwise 0.
+    """
+    table_name = config_["database"]["table_name"]
+    merge_mode = config_["runs"].get("merge_mode", "concat")
+    max_workers = (config_.get("scheduler") or {}).get("max_workers", 1)
+    statuses = get_run_statuses(conn, table_name)
+    with DB_LOCK:
+        done = set(conn.execute("SELECT Run_ID, Name FROM {}_jobs WHERE "
+                                "Status = 'Done'".format(table_name))
+                   .fetchall())
+    rate = merge_rate(conn, table_name, merge_mode)
+    select = job_filter(None, samples)
+    totals = [0, 0, 0, 0.0]
+    code = 0
+    for run in runs:
+        if statuses.get(run) == "Completed":
+            print("{}: already merged".format(os.path.basename(run)))
+            continue
+        run_index = index_run(run, config_["runs"]["in_folder"])
+        ss_info = parse_sample_sheet(run, config_["email"]["admin"], False)
+        try:
+            jobs = build_merge_jobs(run, run_index.samples, ss_info[0])
+        except ValueError as e:
+            print("{}: {}".format(os.path.basename(run), e))
+            code = 1
+            continue
+        for job in jobs:
+            if ((run, job["name"]) in done or 
+                    (select is not None and not select(run, job["samples"]))):
+                continue
+            sizes = job["sizes"]
+            estimate = merge_estimate(config_, sizes, len(sizes) == 1)
+            seconds = sum(sizes) / rate if rate and estimate else 0
+            totals[0] += 1
+            totals[1] += sum(sizes)
+            totals[2] += estimate
+            totals[3] += seconds
+            print("{}: {} from {} files, {:.2f} GB in, {:.2f} GB out, {}"
+                  .format(os.path.basename(run), job["name"], len(sizes),
+                          sum(sizes) / 1e9, estimate / 1e9,
+                          "about {:.0f} s".format(seconds) if rate or not 
+                          estimate else "time unknown"))
+    print("{} merge jobs, {:.2f} GB in, {:.2f} GB out, {} on {} workers."
+          .format(totals[0], totals[1] / 1e9, totals[2] / 1e9,
+                  "about {:.0f} s".format(totals[3] / max_workers) if rate 
+                  else "time unknown", max_workers))
+    return code
+
+def verify_runs(config_, conn, runs):
+    """
+    Check the transfer of runs the way a merge would, against md5sums.txt or
+    by the age of their files, and print the result for every run, without
+    merging anything. The files that match md5sums.txt are remembered, so
+    they are not hashed again when the run is merged. Returns 1 if any of
+    runs is not ready to be merged, otherwise 0.
+    """
+    table_name = config_["database"]["table_name"]
+    verify = config_["verify_transfer"]
+    failed = False
+    for run in runs:
+        run_index = index_run(run, config_["runs"]["in_folder"])
+        bad_files = []
+        if not verify["use_md5"]:
+            ready = check_timestamps(run_index, time()) == 0
+        elif "md5sums.txt" not in run_index:
+            ready = False
+            bad_files.append("md5sums.txt: MISSING")
+        else:
+            with measure("verify", run) as stage:
+                md5_cache = load_md5_cache(conn, table_name, run)
+                cached = dict(md5_cache)
+                results = check_md5(run_index.in_dir, 
+                                    verify.get("md5_workers", 4), False,
+                                    md5_cache, run_index.stat_cache())
+                store_md5_cache(conn, table_name, run, md5_cache)
+                stage.bytes_read = hashed_bytes(run_index.in_dir, results, 
+                                                cached, 
+                                                run_index.stat_cache())
+            bad_files = ["{}: {}".format(name, status) for name, status 
+                         in sorted(results.items()) if status != "OK"]
+            ready = bool(results) and not bad_files
+        failed = failed or not ready
+        print("{}: {}".format(os.path.basename(run), 
+                              "ready" if ready else "not ready"))
+        for line in bad_files:
+            print("    " + line)
+    save_metrics(config_, conn)
+    return 1 if failed else 0
+
+def show_status(config_, conn, runs=None):
+    """
+    Print the status of runs, or of every run in the database if runs is
+    not given, with how many of their merge jobs are in each state, the
+    errors of the jobs that failed, and the deletions and emails that are
+    still to be done. Returns 0.
+    """
+    table_name = config_["database"]["table_name"]
+    with DB_LOCK:
+        rows = conn.execute("SELECT Run_ID, Status, Updated, Host FROM {} "
+                            "ORDER BY Run_ID".format(table_name)).fetchall()
+        job_counts = conn.execute("SELECT Run_ID, Status, COUNT(*) FROM "
+                                  "{}_jobs GROUP BY Run_ID, Status ORDER BY "
+                                  "Status".format(table_name)).fetchall()
+        errors = conn.execute("SELECT Run_ID, Name, Error FROM {}_jobs WHERE "
+                              "Status = 'Failed' ORDER BY Name"
+                              .format(table_name)).fetchall()
+        posts = conn.execute("SELECT Run_ID, Kind, COUNT(*) FROM {}_post "
+                             "WHERE Status != 'Done' GROUP BY Run_ID, Kind "
+                             "ORDER BY Kind".format(table_name)).fetchall()
+    jobs = {}
+    for run, status, count in job_counts:
+        jobs.setdefault(run, []).append("{} {}".format(count, status))
+    pending = {}
+    for run, kind, count in posts:
+        pending.setdefault(run, []).append("{} {}".format(count, kind))
+    for run, status, updated, host in rows:
+        if runs is not None and run not in runs:
+            continue
+        line = "{}: {}".format(os.path.basename(run), status)
+        if updated:
+            line += " since {} UTC".format(strftime("%Y-%m-%d %H:%M:%S", 
+                                                    gmtime(updated)))
+        if host:
+            line += " on {}".format(host)
+        if run in jobs:
+            line += ", jobs: {}".format(", ".join(jobs[run]))
+        if run in pending:
+            line += ", pending: {}".format(", ".join(pending[run]))
+        print(line)
+        for error_run, name, error in errors:
+            if error_run == run:
+                print("    {}: {}".format(name, error))
+    if runs is not None:
+        for run in runs:
+            if run not in set(row[0] for row in rows):
+                print("{}: not seen yet".format(os.path.basename(run)))
+    return 0
+
+def main(config_file, daemon=False, node=None, command="merge", runs=None,
+         samples=None):
+    """
+    Run command on the runs in the runs folder, or only on the runs called
+    runs (see select_runs), and return the exit status. merge verifies and
+    merges them, only the jobs of samples if that is given (see job_filter);
+    plan, verify and status only report (see plan_merges, verify_runs and
+    show_status).
+    """
+    
+    config_ = load_config(config_file)
+    if node is not None:
+        set_node_name(node)
+    set_transport(open_transport(config_["email"]))
+    
+    logging.basicConfig(filename=os.path.join(config_["logging"]["log_file"]),
+                        level = logging.INFO)
+    logging.info("\n")
+    logging.info("Merging script started at {}".
+                 format(strftime("%H:%M:%S, %A, %B %d, %Y", gmtime())))
+
+    logging.info("Config file loaded and parsed successfully at {}."
+                       .format(strftime("%H:%M:%S, %A, %B %d, %Y",gmtime())))      
+    Inbox = config_["runs"]["runs_folder"]
+    logging.info("Base runs folder is {}".format(Inbox))
+    if config_["runs"].get("merge_mode", "concat") == "recompress":
+        logging.info("Recompressing merged files with the {} backend."
+                     .format(config_["compression_settings"]["backend"]))
+    
+    logging.info("Connecting to run database: {}".format(config_["database"]
+                                                         ["name"]))
+    conn = connect_to_db(config_["database"]["location"],
+                         config_["database"]["name"],
+                         config_["database"].get("shared", False))
+    
+    check_db_table(conn, config_["database"]["table_name"])
+    import_completed_file(conn, config_["database"]["table_name"], Inbox)
+    completed = get_completed(conn, config_["database"]["table_name"])
+    if runs:
+        try:
+            directories = select_runs(Inbox, runs)
+        except ValueError as e:
+            logging.error(str(e))
+            print(str(e))
+            return 1
+    else:
+        directories = [directory for directory in list_dir_no_hidden(Inbox)
+                       if directory not in completed]
+    if command == "status":
+        return show_status(config_, conn, directories if runs else None)
+    if command == "plan":
+        return plan_merges(config_, conn, directories, samples)
+    if command == "verify":
+        return verify_runs(config_, conn, directories)
+    
+    evict_md5_cache(conn, config_["database"]["table_name"])
+    if daemon:
+        run_daemon(config_, conn, completed)
+    else:
+        process_runs(config_, conn, completed, directories, 
+                     job_filter(directories if runs else None, samples))
+    
     logging.info("Merging script finished at {}\n"
                  .format(strftime("%H:%M:%S, %A, %B %d, %Y", gmtime())))
+    return 0
       
-'''
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description=__doc__,
                                      formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("command", nargs="?", default="merge",
+                        choices=("merge", "plan", "verify", "status"),
+                        help=("merge (the default) verifies and merges the "
+                              "runs; plan lists the merge jobs with their "
+                              "estimated size and time, verify only checks "
+                              "the transfer of the runs and status shows "
+                              "their state in the database, without "
+                              "changing anything"))
     parser.add_argument("--config_file", help=("Config file for the run "
                                                "combiner in .yaml format"))
+    parser.add_argument("--run", action="append", dest="runs", metavar="RUN",
+                        help=("Only work on this run, a folder in the runs "
+                              "folder. Can be given more than once"))
+    parser.add_argument("--sample", action="append", dest="samples",
+                        metavar="SAMPLE",
+                        help=("Only merge this sample, given by its S number "
+                              "(S1) or its name in the file names. Can be "
+                              "given more than once"))
+    parser.add_argument("--daemon", action="store_true",
+                        help=("Keep running and merge runs as soon as they "
+                              "are ready, instead of checking them once"))
+    parser.add_argument("--node", help=("Name of this node in the run "
+                                        "database (default: the host name)"))
     args = parser.parse_args()
+    if args.daemon and (args.command != "merge" or args.runs or args.samples):
+        parser.error("--daemon can only be used to merge every run.")
+    if args.samples and args.command not in ("merge", "plan"):
+        parser.error("--sample can only be used with merge and plan.")
     
-    main(args.config_file)
+    sys.exit(main(args.config_file, args.daemon, args.node, args.command,
+                  args.runs, args.samples))
     
 '''
 Todo
@@ -0,0 +1,161 @@
+"""
+Directory watchers used by the run combiner in daemon mode. This script is not
+meant to be called as a standalone script, rather it is called from the run
+combiner script.
+
+InotifyWatcher uses the Linux inotify interface through ctypes, so it needs no
+extra packages. PollWatcher compares the names, sizes and modification times
+of the files in the watched directories every time it is asked, and is used
+where inotify is not available. open_watcher picks the best one available.
+"""
+
+import os
+import ctypes
+import ctypes.util
+import errno
+import select
+import struct
+import logging
+from time import sleep
+
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_NONBLOCK = 0x00000800
+IN_CLOEXEC = 0x00080000
+WATCH_MASK = (IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO |
+              IN_CREATE | IN_DELETE | IN_DELETE_SELF)
+EVENT_HEADER = struct.Struct("iIII")
+
+class InotifyWatcher(object):
+    """
+    Watch directories with inotify. wait returns the directories in which
+    anything was created, written, moved or deleted.
+    """
+
+    def __init__(self):
+        libc_name = ctypes.util.find_library("c")
+        if libc_name is None:
+            raise OSError(errno.ENOSYS, "The C library could not be found.")
+        self.libc = ctypes.CDLL(libc_name, use_errno=True)
+        if not hasattr(self.libc, "inotify_init1"):
+            raise OSError(errno.ENOSYS, "inotify is not available.")
+        self.fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed.")
+        self.paths = {}
+        self.watches = {}
+
+    def add(self, path):
+        if path in self.watches:
+            return
+        wd = self.libc.inotify_add_watch(self.fd, path.encode("utf-8"),
+                                         WATCH_MASK)
+        if wd < 0:
+            raise OSError(ctypes.get_errno(), "Can not watch {}".format(path))
+        self.paths[wd] = path
+        self.watches[path] = wd
+
+    def remove(self, path):
+        wd = self.watches.pop(path, None)
+        if wd is not None:
+            self.paths.pop(wd, None)
+            self.libc.inotify_rm_watch(self.fd, wd)
+
+    def wait(self, timeout):
+        """
+        Wait up to timeout seconds for changes and return the set of watched
+        directories that changed.
+        """
+        readable = select.select([self.fd], [], [], timeout)[0]
+        changed = set()
+        if not readable:
+            return changed
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except OSError as e:
+            if e.errno == errno.EAGAIN:
+                return changed
+            raise
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, length = EVENT_HEADER.unpack_from(data, offset)
+            offset += EVENT_HEADER.size + length
+            if mask & IN_Q_OVERFLOW:
+                logging.warning("inotify queue overflowed, treating every "
+                                "watched directory as changed.")
+                changed.update(self.watches)
+                continue
+            path = self.paths.get(wd)
+            if path is None:
+                continue
+            if mask & IN_IGNORED:
+                del self.paths[wd]
+                self.watches.pop(path, None)
+            changed.add(path)
+        return changed
+
+    def close(self):
+        os.close(self.fd)
+
+class PollWatcher(object):
+    """
+    Watch directories by comparing the name, size and modification time of
+    their entries every interval seconds.
+    """
+
+    def __init__(self, interval=60):
+        self.interval = interval
+        self.snapshots = {}
+
+    def snapshot(self, path):
+        entries = []
+        try:
+            names = os.listdir(path)
+        except OSError:
+            return None
+        for name in names:
+            try:
+                stat = os.stat(os.path.join(path, name))
+            except OSError:
+                continue
+            entries.append((name, stat.st_size, stat.st_mtime))
+        return frozenset(entries)
+
+    def add(self, path):
+        if path not in self.snapshots:
+            self.snapshots[path] = self.snapshot(path)
+
+    def remove(self, path):
+        self.snapshots.pop(path, None)
+
+    def wait(self, timeout):
+        sleep(min(timeout, self.interval))
+        changed = set()
+        for path in list(self.snapshots):
+            snapshot = self.snapshot(path)
+            if snapshot != self.snapshots[path]:
+                self.snapshots[path] = snapshot
+                changed.add(path)
+        return changed
+
+    def close(self):
+        pass
+
+def open_watcher(poll_interval=60):
+    """
+    Return an InotifyWatcher if inotify is available, otherwise a
+    PollWatcher.
+    """
+    try:
+        return InotifyWatcher()
+    except (OSError, AttributeError):
+        logging.info("inotify is not available, polling directories every "
+                     "{} seconds instead.".format(poll_interval))
+        return PollWatcher(poll_interval)